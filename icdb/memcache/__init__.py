@@ -2,4 +2,4 @@
 # from cache_ttl import CacheTTL
 # from cache_mw import CacheMW
 
-__all__ = ['cache','cache_mw','cache_ttl']
\ No newline at end of file
+__all__ = ['cache','cache_mw','cache_ttl','bloomfilter','policy']
\ No newline at end of file
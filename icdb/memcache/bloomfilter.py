@@ -0,0 +1,124 @@
+# -------------------------------#
+# Written by icoz, 2013          #
+# email: icoz.vt at gmail.com    #
+# License: GPL v3                #
+# -------------------------------#
+
+from hashlib import md5
+from math import ceil, log
+import struct
+
+
+def hash_md5(info):
+    ''' for hashing using MD5 '''
+    m = md5()
+    m.update(str(info).encode())
+    return m.digest()
+
+
+class BloomFilter(object):
+
+    """
+    BloomFilter is probabilistic set of keys
+    - no false negatives: if key was added, 'key in bf' is True
+    - false positives with rate fp_rate, while count of keys <= capacity
+    - bits are kept in bytearray, k positions are taken from md5 of key
+    - save/load is implemented, tag is saved too, owner can use it to
+        match filter with data it was built for
+
+    File struct:
+      magic, 4 byte = b'\\x6a\\xe0\\x0b\\x20'
+      k, 4 bytes
+      count, 8 bytes
+      capacity, 8 bytes
+      fp_rate, 8 bytes (double)
+      tag, 8 bytes
+      bits, (bits count + 7) / 8 bytes
+    """
+    MAGIC_NUMBER = b'\x6a\xe0\x0b\x20'
+    HEADER = struct.Struct('<iqqdq')
+
+    def __init__(self, capacity=1000, fp_rate=0.01):
+        '''
+        capacity - how much keys can be added before fp_rate is exceeded
+        fp_rate - rate of false positives
+        '''
+        self.capacity = max(int(capacity), 1)
+        self.fp_rate = float(fp_rate)
+        # optimal count of bits and hash functions
+        self.m = int(ceil(-self.capacity * log(self.fp_rate) / log(2) ** 2))
+        self.k = max(int(round(self.m / self.capacity * log(2))), 1)
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+        self.tag = 0
+
+    def __contains__(self, key):
+        if type(key) is not str:
+            key = str(key)
+        return self.contains_hash(hash_md5(key))
+
+    def add(self, key):
+        if type(key) is not str:
+            key = str(key)
+        self.add_hash(hash_md5(key))
+
+    def __positions__(self, hash):
+        ''' internal. k bit positions for hash (double hashing) '''
+        h1 = int.from_bytes(hash[:8], 'little')
+        h2 = int.from_bytes(hash[8:16], 'little') | 1
+        m = self.m
+        return [(h1 + i * h2) % m for i in range(self.k)]
+
+    def add_hash(self, hash):
+        ''' add key by its md5 hash '''
+        bits = self.bits
+        m = self.m
+        # __positions__ inlined, it is called for every key on rebuild
+        h1 = int.from_bytes(hash[:8], 'little')
+        h2 = int.from_bytes(hash[8:16], 'little') | 1
+        for i in range(self.k):
+            pos = (h1 + i * h2) % m
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count = self.count + 1
+
+    def contains_hash(self, hash):
+        ''' check key by its md5 hash '''
+        bits = self.bits
+        for pos in self.__positions__(hash):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        ''' True if more keys than capacity were added '''
+        return self.count > self.capacity
+
+    def save(self, fname):
+        with open(fname, 'wb') as fout:
+            fout.write(self.MAGIC_NUMBER)
+            fout.write(self.HEADER.pack(self.k, self.count, self.capacity,
+                                        self.fp_rate, self.tag))
+            fout.write(self.bits)
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        Load filter from file 'fname'
+        If file is absent or broken, None will be returned
+        '''
+        try:
+            with open(fname, 'rb') as fin:
+                b = fin.read()
+        except FileNotFoundError:
+            return None
+        start = 4 + cls.HEADER.size
+        if len(b) < start or b[:4] != cls.MAGIC_NUMBER:
+            return None
+        k, count, capacity, fp_rate, tag = cls.HEADER.unpack_from(b, 4)
+        bf = cls(capacity, fp_rate)
+        if bf.k != k or len(b) - start != len(bf.bits):
+            return None
+        bf.bits[:] = b[start:]
+        bf.count = count
+        bf.tag = tag
+        return bf
@@ -47,8 +47,7 @@ class Cache(object):
     def save(self, fname=None):
         if fname is not None:
             with Storage(fname) as s:
-                for k in self.data:
-                    s.set_unsafe(k, self.data[k])
+                s.set_many(self.data)
 
     def load(self, fname=None):
         if fname is not None:
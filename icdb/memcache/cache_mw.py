@@ -5,29 +5,48 @@
 # -------------------------------#
 
 from icdb.storage.storage import Storage
-from datetime import datetime, timedelta
+from icdb.memcache.policy import policy_class
 import os
+import sys
+from unittest import TestCase
 
 
 class CacheMW(object):
 
     """
     CacheMW is mem-storage for key-value, with limit on count of stored key-values
-    - based on dict()
-    - last time used (LTU) saves with value
-    - on set check limit and if exceed delete most old LTU in cache
+    - based on dict(), order of keys is kept by policy, see policy.py
+    - get and set are O(1) for all policies
+    - on set check limit and if exceed delete keys chosen by policy,
+        least recently used by default
+    - optional max_bytes limits size of keys and values, see sizeof
     """
 
-    def __init__(self, filename=None, limit=1000, on_limit_cleanup=100):
+    def __init__(self, filename=None, limit=1000, on_limit_cleanup=100, max_bytes=None, sizeof=None,
+                 policy='lru'):
         '''
         if filename is passed, then try to load from file
         limit by default = 1000, limits count of pairs(key,value) in cache
         on_limit_cleanup = 100, how much records we must delete in cache on limit
+        max_bytes = None, if set, limits sum of sizes of keys and values,
+            keys chosen by policy are deleted till sum fits
+        sizeof = None, function(value) -> size of value in bytes, by default
+            sys.getsizeof, size of key is sys.getsizeof(key)
+        policy = 'lru', eviction policy: 'lru', 'tinylfu', 'arc', '2q' or
+            callable(limit) returning policy object
         '''
-        # data is dict(key: tuple(value, ltu), key: tuple(value, ltu) ...)
+        # data is dict(key: value, ...)
         self.data = dict()
         self.limit = int(limit)
+        self.policy_class = policy_class(policy)
+        self.policy = self.policy_class(self.limit)
         self.on_limit_cleanup = int(on_limit_cleanup)
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+        self.sizeof = sys.getsizeof if sizeof is None else sizeof
+        # sizes is dict(key: size), kept only if max_bytes is set
+        self.sizes = dict()
+        # sum of sizes
+        self.bytes = 0
         if filename is not None:
             if os.path.exists(filename):
                 self.load(filename)
@@ -41,26 +60,37 @@ class CacheMW(object):
             key = str(key)
         # find value for key
         try:
-            val = self.data[key][0]
-            self.data[key][1] = datetime.utcnow()
+            val = self.data[key]
         except KeyError:
             return None
+        self.policy.hit(key)
         return val
 
     def set(self, key, value):
         '''
         Set key-value
-        If exceeds limit, then kill most old LTU
+        If exceeds limit, then kill keys chosen by policy
         '''
         if type(key) is not str:
             key = str(key)
-        self.data[key] = [value, datetime.utcnow()]
+        if key in self.data:
+            self.policy.hit(key)
+        else:
+            self.policy.insert(key)
+        self.data[key] = value
+        if self.max_bytes is not None:
+            size = self.__entry_size__(key, value)
+            self.bytes += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            if self.bytes > self.max_bytes:
+                self.cleanup()
+                return
         if len(self.data) > self.limit:
             self.cleanup()
 
     def delete(self, key):
         '''
-        Delete value (and LTU) for given key-value
+        Delete value for given key-value
         '''
         if type(key) is not str:
             key = str(key)
@@ -68,28 +98,32 @@ class CacheMW(object):
             del self.data[key]
         except KeyError:
             pass
+        else:
+            self.policy.remove(key)
+            self.bytes -= self.sizes.pop(key, 0)
 
     def cleanup(self):
         '''
-        Cleanup values with most old LTU
+        Cleanup values chosen by policy
         count for delete can be set by defining on_limit_cleanup in __init__
+        if max_bytes is set, values are deleted till sum of sizes fits it
         '''
-        # get ltu and keys
-        ltu_key = dict()
-        ltu_sort = []
-        for k in self.data:
-            # use 'LTU' as key, 'key' as value
-            ltu = self.data[k][1]
-            ltu_key[ltu] = k
-            ltu_sort.append(ltu)
-        # sort ltu
-        ltu_sort = sorted(ltu_sort)
-        # get top100 and kill 'em
-        # we must left in cache only (limit-on_limit_cleanup) values
-        # so we must kill 'count' entries
-        count = len(self.data) - (self.limit - self.on_limit_cleanup)
-        for i in range(count):
-            del self.data[ltu_key[ltu_sort[i]]]
+        data = self.data
+        sizes = self.sizes
+        evict = self.policy.evict
+        if len(data) > self.limit:
+            # we must left in cache only (limit-on_limit_cleanup) values
+            # so we must kill 'count' entries chosen by policy
+            count = len(data) - max(self.limit - self.on_limit_cleanup, 0)
+            for i in range(count):
+                k = evict()
+                del data[k]
+                self.bytes -= sizes.pop(k, 0)
+        if self.max_bytes is not None:
+            while self.bytes > self.max_bytes and data:
+                k = evict()
+                del data[k]
+                self.bytes -= sizes.pop(k, 0)
 
     def save(self, fname=None):
         '''
@@ -98,8 +132,7 @@ class CacheMW(object):
         '''
         if fname is not None:
             with Storage(fname) as s:
-                for k in self.data:
-                    s.set_unsafe(k, self.data[k][0])
+                s.set_many(self.data.items())
 
     def load(self, fname=None, append=False):
         '''
@@ -112,10 +145,45 @@ class CacheMW(object):
                 data = s.get_dict()
             # if not append, then delete current data
             if not append:
-                del self.data
                 self.data = dict()
+                self.policy = self.policy_class(self.limit)
+                self.sizes = dict()
+                self.bytes = 0
+            # loaded keys become most recently used
             for k in data:
-                self.data[k] = (data[k], datetime.utcnow())
-            # cleanup loaded key-values if exceeds limit
-            if len(self.data) > self.limit:
-                self.cleanup()
+                self.set(k, data[k])
+
+    def __entry_size__(self, key, value):
+        ''' internal. Size of key-value in bytes '''
+        return sys.getsizeof(key) + self.sizeof(value)
+
+
+class CacheMWTest(TestCase):
+    def test_max_bytes(self):
+        key_size = sys.getsizeof('1')
+        c = CacheMW(limit=100, max_bytes=4 * (key_size + 200), sizeof=len)
+        c.set(1, 'x' * 100)
+        self.assertEqual(key_size + 100, c.bytes)
+        # overwrite
+        c.set(1, 'x' * 10)
+        self.assertEqual(key_size + 10, c.bytes)
+        c.delete(1)
+        c.delete(1)
+        self.assertEqual(0, c.bytes)
+        # least recently used are evicted till sum fits
+        for i in range(6):
+            c.set(i, 'x' * 200)
+        c.get(2)
+        c.set(6, 'x' * 200)
+        self.assertEqual(['2', '4', '5', '6'], sorted(c.data))
+        self.assertEqual(4 * (key_size + 200), c.bytes)
+        # value bigger than budget is not kept
+        c.set(7, 'x' * 10000)
+        self.assertEqual({}, c.data)
+        self.assertEqual(0, c.bytes)
+        # eviction by count keeps sum too
+        c = CacheMW(limit=3, on_limit_cleanup=1, max_bytes=10000, sizeof=len)
+        for i in range(5):
+            c.set(i, 'x' * i)
+        self.assertEqual(['2', '3', '4'], sorted(c.data))
+        self.assertEqual(sum(sys.getsizeof(k) + len(v) for k, v in c.data.items()), c.bytes)
@@ -5,34 +5,34 @@
 # -------------------------------#
 
 from icdb.storage.storage import Storage
-from datetime import datetime, timedelta
+from datetime import timedelta
+import heapq
 import os
+import sys
+import time
+from unittest import TestCase
 
 
-class CacheTTL(object):
+class TTLEntry(object):
 
     """
-    CacheTTL is mem-storage for key-value
-    - based on dict()
-    - uses ttl for store values, default ttl = 1 min
-    - can exceed limit on put key-value, but it will be slow,
-        because on every put cleanup() will be called
-    - save/load is implemented
-    - load will cleanup values with timeouted TTL
-    - saving in two files: filename, filename.ttl
+    Value with its expiry time, time.monotonic() seconds, and size in bytes
     """
+    __slots__ = ('value', 'expiry', 'size')
 
-    def __init__(self, filename=None, limit=1000):
-        '''
-        if filename is passed, then try to load from file
-        limit by default = 1000
-        '''
-        self.data = dict()
-        self.ttl = dict()
-        self.limit = int(limit)
-        if filename is not None:
-            if os.path.exists(filename):
-                self.load(filename)
+    def __init__(self, value, expiry, size=0):
+        self.value = value
+        self.expiry = expiry
+        self.size = size
+
+
+class TTLEntries(object):
+
+    """
+    internal. Common part of CacheTTL and CacheTTLStrict: data is
+    dict(key: TTLEntry), expiry is heap of (expiry, key), bytes is sum of
+    sizes of entries
+    """
 
     def get(self, key):
         '''
@@ -43,43 +43,15 @@ class CacheTTL(object):
             key = str(key)
         # find value for key
         try:
-            val = self.data[key]
+            entry = self.data[key]
         except KeyError:
             return None
-        # find ttl for key
-        try:
-            ttl = self.ttl[key]
-        except KeyError:
-            # if no ttl, but we have value for this key, then del value
+        if entry.expiry < time.monotonic():
+            # print('get: ttl expired')
             del self.data[key]
+            self.bytes -= entry.size
             return None
-        else:
-            if type(ttl) is datetime:
-                if ttl < datetime.utcnow():
-                    # print('get: ttl expired')
-                    val = None
-                    del self.data[key]
-                    del self.ttl[key]
-            else:
-                # if ttl is not datetime, then del ttl and value for this key
-                val = None
-                del self.data[key]
-                del self.ttl[key]
-        return val
-
-    def set(self, key, value, ttl=timedelta(minutes=1)):
-        '''
-        Set key-value with given TTL
-        If TTL is not type(timedelta) then no value will be stored, None will be returned
-        '''
-        if type(key) is not str:
-            key = str(key)
-        if type(ttl) is not timedelta:
-            return None
-        self.data[key] = value
-        self.ttl[key] = datetime.utcnow() + ttl
-        if len(self.ttl) > self.limit:
-            self.cleanup()
+        return entry.value
 
     def delete(self, key):
         '''
@@ -88,51 +60,24 @@ class CacheTTL(object):
         if type(key) is not str:
             key = str(key)
         try:
-            del self.data[key]
-            del self.ttl[key]
+            entry = self.data.pop(key)
         except KeyError:
             pass
-
-    def cleanup(self):
-        ''' Cleanup outdated values '''
-        key_to_del = []
-        # find keys with timeouted TTL
-        for k in self.ttl:
-            v = self.ttl[k]
-            if type(v) is datetime:
-                if v < datetime.utcnow():
-                    key_to_del.append(k)
-        # delete values and TTLs for it
-        for k in key_to_del:
-            del self.ttl[k]
-            del self.data[k]
-        # check values without ttl
-        if len(self.data) > len(self.ttl):
-            for k in self.data:
-                try:
-                    self.ttl[k]
-                except KeyError:
-                    del self.data[k]
-        # check ttl without values
-        if len(self.data) < len(self.ttl):
-            for k in self.ttl:
-                try:
-                    self.value[k]
-                except KeyError:
-                    del self.ttl[k]
+        else:
+            self.bytes -= entry.size
 
     def save(self, fname=None):
         '''
         Save cache to file 'fname'
         If fname is None, None will be saved. ;-)
+        TTL is saved as wall clock time of expiry, time.time() seconds
         '''
         if fname is not None:
+            shift = time.time() - time.monotonic()
             with Storage(fname) as s:
-                for k in self.data:
-                    s.set_unsafe(k, self.data[k])
+                s.set_many((k, e.value) for k, e in self.data.items())
             with Storage(fname + '.ttl') as s:
-                for k in self.data:
-                    s.set_unsafe(k, self.data[k])
+                s.set_many((k, repr(e.expiry + shift)) for k, e in self.data.items())
 
     def load(self, fname=None, append=False):
         '''
@@ -145,9 +90,217 @@ class CacheTTL(object):
                 data = s.get_dict()
             with Storage(fname + '.ttl') as s:
                 ttl = s.get_dict()
-            if append:
-                for k in data:
-                    self.data[k] = data[k]
-                    self.ttl[k] = ttl[k]
+            # if not append, then delete current data
+            if not append:
+                self.data = dict()
+                self.bytes = 0
+            shift = time.time() - time.monotonic()
+            for k in data:
+                # value without ttl is not loaded
+                try:
+                    expiry = float(ttl[k]) - shift
+                except (KeyError, ValueError):
+                    continue
+                entry = TTLEntry(data[k], expiry)
+                if self.max_bytes is not None:
+                    entry.size = self.__entry_size__(k, data[k])
+                self.__put__(k, entry)
+            self.__heapify__()
             # cleanup loaded key-values for timeouted TTL
             self.cleanup()
+
+    def __put__(self, key, entry):
+        ''' internal. Stores entry for key, its size is added to bytes '''
+        old = self.data.get(key)
+        if old is not None:
+            self.bytes -= old.size
+        self.data[key] = entry
+        self.bytes += entry.size
+        self.__push__(key, entry.expiry)
+
+    def __entry_size__(self, key, value):
+        ''' internal. Size of key-value in bytes '''
+        return sys.getsizeof(key) + self.sizeof(value)
+
+    def __push__(self, key, expiry):
+        ''' internal. Adds expiry of key to heap '''
+        heapq.heappush(self.expiry, (expiry, key))
+        # drop skipped entries, when they are most of heap
+        if len(self.expiry) > 2 * len(self.data) + 64:
+            self.__heapify__()
+
+    def __heapify__(self):
+        ''' internal. Builds heap of expiry from data '''
+        self.expiry = [(e.expiry, k) for k, e in self.data.items()]
+        heapq.heapify(self.expiry)
+
+
+class CacheTTL(TTLEntries):
+
+    """
+    CacheTTL is mem-storage for key-value
+    - based on dict() of TTLEntry(value, expiry)
+    - uses ttl for store values, default ttl = 1 min
+    - expiry is time.monotonic() seconds, so it does not depend on
+        changes of wall clock
+    - can exceed limit on put key-value, then on every put cleanup() will
+        be called, it pops expired keys from heap of expiry times, so it
+        costs O(log n) per expired key and nothing else
+    - optional max_bytes limits size of keys and values, values which
+        expire first are deleted till it fits
+    - save/load is implemented
+    - load will cleanup values with timeouted TTL
+    - saving in two files: filename, filename.ttl
+    """
+
+    def __init__(self, filename=None, limit=1000, max_bytes=None, sizeof=None):
+        '''
+        if filename is passed, then try to load from file
+        limit by default = 1000
+        max_bytes = None, if set, limits sum of sizes of keys and values
+        sizeof = None, function(value) -> size of value in bytes, by default
+            sys.getsizeof, size of key is sys.getsizeof(key)
+        '''
+        # data is dict(key: TTLEntry(value, expiry), ...)
+        self.data = dict()
+        # heap of (expiry, key), entries of deleted and overwritten
+        # keys are left in heap and skipped on pop
+        self.expiry = []
+        self.limit = int(limit)
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+        self.sizeof = sys.getsizeof if sizeof is None else sizeof
+        # sum of sizes of entries, sizes are counted only if max_bytes is set
+        self.bytes = 0
+        if filename is not None:
+            if os.path.exists(filename):
+                self.load(filename)
+
+    def set(self, key, value, ttl=timedelta(minutes=1)):
+        '''
+        Set key-value with given TTL
+        If TTL is not type(timedelta) then no value will be stored, None will be returned
+        '''
+        if type(key) is not str:
+            key = str(key)
+        if type(ttl) is not timedelta:
+            return None
+        entry = TTLEntry(value, time.monotonic() + ttl.total_seconds())
+        if self.max_bytes is not None:
+            entry.size = self.__entry_size__(key, value)
+        self.__put__(key, entry)
+        if len(self.data) > self.limit or \
+                self.max_bytes is not None and self.bytes > self.max_bytes:
+            self.cleanup()
+
+    def cleanup(self):
+        '''
+        Cleanup outdated values
+        If max_bytes is set, values which expire first are deleted till
+        sum of sizes fits it
+        '''
+        # find keys with timeouted TTL, they are at the top of heap
+        now = time.monotonic()
+        data = self.data
+        expiry = self.expiry
+        max_bytes = self.max_bytes
+        while expiry and (expiry[0][0] < now or
+                          max_bytes is not None and self.bytes > max_bytes):
+            v, k = heapq.heappop(expiry)
+            # skip entry if key was deleted or set again with other TTL
+            entry = data.get(k)
+            if entry is not None and entry.expiry == v:
+                del data[k]
+                self.bytes -= entry.size
+
+
+class TTLEntriesTests(object):
+    """ Tests for both CacheTTL and CacheTTLStrict, CACHE is class to test """
+    FILENAME = 'test.cache_ttl.icdb'
+    CACHE = None
+
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        for name in os.listdir('.'):
+            if name.startswith(self.FILENAME):
+                os.unlink(name)
+
+    def test_save_load(self):
+        c = self.CACHE(limit=10)
+        c.set('a', 'one', timedelta(minutes=5))
+        c.set('b', 2, timedelta(seconds=30))
+        c.set('c', 'gone', timedelta(milliseconds=10))
+        time.sleep(0.05)
+        c.save(self.FILENAME)
+        c2 = self.CACHE(self.FILENAME)
+        # values are loaded as str, expired ones are not loaded
+        self.assertEqual(['a', 'b'], sorted(c2.data))
+        self.assertEqual('one', c2.get('a'))
+        self.assertEqual('2', c2.get('b'))
+        # remaining TTL is kept
+        self.assertAlmostEqual(300, c2.data['a'].expiry - time.monotonic(), delta=1)
+        self.assertAlmostEqual(30, c2.data['b'].expiry - time.monotonic(), delta=1)
+        # load replaces cache, unless append is set
+        c2 = self.CACHE()
+        c2.set('x', 'x')
+        c2.load(self.FILENAME)
+        self.assertEqual(['a', 'b'], sorted(c2.data))
+        c2.set('x', 'x')
+        c2.load(self.FILENAME, append=True)
+        self.assertEqual(['a', 'b', 'x'], sorted(c2.data))
+        # heap is rebuilt, loaded keys expire
+        c2.data['a'].expiry = time.monotonic() - 1
+        c2.__heapify__()
+        c2.cleanup()
+        self.assertEqual(['b', 'x'], sorted(c2.data))
+
+
+class CacheTTLTest(TTLEntriesTests, TestCase):
+    CACHE = CacheTTL
+
+    def test_expiry(self):
+        c = CacheTTL(limit=3)
+        c.set('a', 1, timedelta(milliseconds=10))
+        c.set('b', 2, timedelta(milliseconds=10))
+        # re-set key, its first entry in heap is stale now
+        c.set('b', 3, timedelta(minutes=1))
+        c.set('c', 4)
+        time.sleep(0.05)
+        self.assertIsNone(c.get('a'))
+        c.set('a', 1, timedelta(milliseconds=10))
+        time.sleep(0.05)
+        # over limit, expired keys are swept
+        c.set('d', 5)
+        self.assertEqual(['b', 'c', 'd'], sorted(c.data))
+        self.assertEqual(3, c.get('b'))
+        # heap does not grow with re-sets of the same key
+        for i in range(1000):
+            c.set('b', i)
+        self.assertLessEqual(len(c.expiry), 2 * len(c.data) + 65)
+        self.assertEqual(999, c.get('b'))
+
+    def test_max_bytes(self):
+        key_size = sys.getsizeof('1')
+        c = CacheTTL(limit=100, max_bytes=3 * (key_size + 100), sizeof=len)
+        c.set(1, 'x' * 100)
+        self.assertEqual(key_size + 100, c.bytes)
+        # overwrite
+        c.set(1, 'x' * 10)
+        self.assertEqual(key_size + 10, c.bytes)
+        c.delete(1)
+        c.delete(1)
+        self.assertEqual(0, c.bytes)
+        # expired values are removed by get and cleanup
+        c.set(1, 'x' * 100, timedelta(milliseconds=10))
+        c.set(2, 'x' * 100, timedelta(milliseconds=10))
+        time.sleep(0.05)
+        self.assertIsNone(c.get(1))
+        self.assertEqual(key_size + 100, c.bytes)
+        c.cleanup()
+        self.assertEqual(0, c.bytes)
+        # values which expire first are evicted till sum fits
+        for i in range(5):
+            c.set(i, 'x' * 100, timedelta(minutes=10 - i))
+        self.assertEqual(['0', '1', '2'], sorted(c.data))
+        self.assertEqual(3 * (key_size + 100), c.bytes)
@@ -4,70 +4,56 @@
 # License: GPL v3                #
 # -------------------------------#
 
-from icdb.storage.storage import Storage
-from datetime import datetime, timedelta
+from icdb.memcache.cache_ttl import TTLEntries, TTLEntriesTests, TTLEntry
+from datetime import timedelta
+import heapq
 import os
+import sys
+import time
+from unittest import TestCase
 
 
-class CacheTTLStrict(object):
+class CacheTTLStrict(TTLEntries):
 
     """
     CacheTTLStrict is mem-storage for key-value
-    - based on dict()
+    - based on dict() of TTLEntry(value, expiry)
     - strict because if limit reached it doesn't accept set(k,v)
     - uses ttl for store values, default ttl = 1 min
-    - can exceed limit on put key-value, but it will be slow,
-        because on every put cleanup() will be called
+    - expiry is time.monotonic() seconds, so it does not depend on
+        changes of wall clock
+    - can exceed limit on put key-value, then on every put cleanup() will
+        be called, it pops expired keys from heap of expiry times, so it
+        costs O(log n) per expired key and nothing else
+    - optional max_bytes limits size of keys and values, set(k,v) is
+        not accepted if it doesn't fit
     - save/load is implemented
     - load will cleanup values with timeouted TTL
     - saving in two files: filename, filename.ttl
     """
 
-    def __init__(self, filename=None, limit=1000):
+    def __init__(self, filename=None, limit=1000, max_bytes=None, sizeof=None):
         '''
         if filename is passed, then try to load from file
         limit by default = 1000
+        max_bytes = None, if set, limits sum of sizes of keys and values
+        sizeof = None, function(value) -> size of value in bytes, by default
+            sys.getsizeof, size of key is sys.getsizeof(key)
         '''
+        # data is dict(key: TTLEntry(value, expiry), ...)
         self.data = dict()
-        self.ttl = dict()
+        # heap of (expiry, key), entries of deleted and overwritten
+        # keys are left in heap and skipped on pop
+        self.expiry = []
         self.limit = int(limit)
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+        self.sizeof = sys.getsizeof if sizeof is None else sizeof
+        # sum of sizes of entries, sizes are counted only if max_bytes is set
+        self.bytes = 0
         if filename is not None:
             if os.path.exists(filename):
                 self.load(filename)
 
-    def get(self, key):
-        '''
-        Get value by key
-        If value is timeouted 'None' will be returned
-        '''
-        if type(key) is not str:
-            key = str(key)
-        # find value for key
-        try:
-            val = self.data[key]
-        except KeyError:
-            return None
-        # find ttl for key
-        try:
-            ttl = self.ttl[key]
-        except KeyError:
-            # if no ttl, but we have value for this key, then del value
-            del self.data[key]
-            return None
-        else:
-            if type(ttl) is datetime:
-                if ttl < datetime.utcnow():
-                    # print('get: ttl expired')
-                    val = None
-                    del self.data[key]
-                    del self.ttl[key]
-            else:
-                # if ttl is not datetime, then del ttl and value for this key
-                val = None
-                del self.data[key]
-                del self.ttl[key]
-        return val
-
     def set(self, key, value, ttl=timedelta(minutes=1)):
         '''
         Set key-value with given TTL
@@ -79,82 +65,84 @@ class CacheTTLStrict(object):
             key = str(key)
         if type(ttl) is not timedelta:
             return False
-        if len(self.ttl) > self.limit:
+        size = 0
+        if self.max_bytes is not None:
+            size = self.__entry_size__(key, value)
+        if len(self.data) >= self.limit or not self.__fits__(key, size):
             self.cleanup()
-        if len(self.ttl) < self.limit:
-            self.data[key] = value
-            self.ttl[key] = datetime.utcnow() + ttl
+        if len(self.data) < self.limit and self.__fits__(key, size):
+            self.__put__(key, TTLEntry(value, time.monotonic() + ttl.total_seconds(), size))
         else:
             return False
         return True
 
-    def delete(self, key):
-        '''
-        Delete value (and TTL) for given key-value
-        '''
-        if type(key) is not str:
-            key = str(key)
-        try:
-            del self.data[key]
-            del self.ttl[key]
-        except KeyError:
-            pass
-
     def cleanup(self):
         ''' Cleanup outdated values '''
-        key_to_del = []
-        # find keys with timeouted TTL
-        for k in self.ttl:
-            v = self.ttl[k]
-            if type(v) is datetime:
-                if v < datetime.utcnow():
-                    key_to_del.append(k)
-        # delete values and TTLs for it
-        for k in key_to_del:
-            del self.ttl[k]
-            del self.data[k]
-        # check values without ttl
-        if len(self.data) > len(self.ttl):
-            for k in self.data:
-                try:
-                    self.ttl[k]
-                except KeyError:
-                    del self.data[k]
-        # check ttl without values
-        if len(self.data) < len(self.ttl):
-            for k in self.ttl:
-                try:
-                    self.value[k]
-                except KeyError:
-                    del self.ttl[k]
+        # find keys with timeouted TTL, they are at the top of heap
+        now = time.monotonic()
+        data = self.data
+        expiry = self.expiry
+        while expiry and expiry[0][0] < now:
+            v, k = heapq.heappop(expiry)
+            # skip entry if key was deleted or set again with other TTL
+            entry = data.get(k)
+            if entry is not None and entry.expiry < now:
+                del data[k]
+                self.bytes -= entry.size
 
-    def save(self, fname=None):
-        '''
-        Save cache to file 'fname'
-        If fname is None, None will be saved. ;-)
-        '''
-        if fname is not None:
-            with Storage(fname) as s:
-                for k in self.data:
-                    s.set_unsafe(k, self.data[k])
-            with Storage(fname + '.ttl') as s:
-                for k in self.data:
-                    s.set_unsafe(k, self.data[k])
+    def __fits__(self, key, size):
+        ''' internal. Checks if entry of size fits max_bytes instead of entry for key '''
+        if self.max_bytes is None:
+            return True
+        old = self.data.get(key)
+        return self.bytes - (0 if old is None else old.size) + size <= self.max_bytes
 
-    def load(self, fname=None, append=False):
-        '''
-        Load cache from file 'fname'
-        Current cache will be removed (by default), to append data from file to cache, set param 'append=True'
-        If fname is None, None will be loaded. ;-) But current cache stays alive.
-        '''
-        if fname is not None:
-            with Storage(fname) as s:
-                data = s.get_dict()
-            with Storage(fname + '.ttl') as s:
-                ttl = s.get_dict()
-            if append:
-                for k in data:
-                    self.data[k] = data[k]
-                    self.ttl[k] = ttl[k]
-            # cleanup loaded key-values for timeouted TTL
-            self.cleanup()
+
+class CacheTTLStrictTest(TTLEntriesTests, TestCase):
+    CACHE = CacheTTLStrict
+
+    def test_expiry(self):
+        c = CacheTTLStrict(limit=3)
+        self.assertTrue(c.set('a', 1, timedelta(milliseconds=10)))
+        self.assertTrue(c.set('b', 2, timedelta(milliseconds=10)))
+        # re-set key, its first entry in heap is stale now
+        self.assertTrue(c.set('b', 3, timedelta(minutes=1)))
+        self.assertTrue(c.set('c', 4))
+        # at limit, nothing is expired yet
+        self.assertFalse(c.set('d', 5))
+        time.sleep(0.05)
+        # at limit expired keys are swept
+        self.assertTrue(c.set('d', 5))
+        self.assertEqual(['b', 'c', 'd'], sorted(c.data))
+        self.assertEqual(3, c.get('b'))
+        self.assertIsNone(c.get('a'))
+        # heap does not grow with re-sets of the same key
+        c.delete('d')
+        for i in range(1000):
+            self.assertTrue(c.set('b', i))
+        self.assertLessEqual(len(c.expiry), 2 * len(c.data) + 65)
+        self.assertEqual(999, c.get('b'))
+
+    def test_max_bytes(self):
+        key_size = sys.getsizeof('1')
+        c = CacheTTLStrict(limit=100, max_bytes=3 * (key_size + 100), sizeof=len)
+        self.assertTrue(c.set(1, 'x' * 100))
+        # overwrite
+        self.assertTrue(c.set(1, 'x' * 10))
+        self.assertEqual(key_size + 10, c.bytes)
+        c.delete(1)
+        self.assertEqual(0, c.bytes)
+        self.assertTrue(c.set(1, 'x' * 100, timedelta(milliseconds=10)))
+        self.assertTrue(c.set(2, 'x' * 100))
+        self.assertTrue(c.set(3, 'x' * 100))
+        # does not fit
+        self.assertFalse(c.set(4, 'x' * 100))
+        self.assertEqual(3 * (key_size + 100), c.bytes)
+        # but overwrite of the same size fits
+        self.assertTrue(c.set(3, 'y' * 100))
+        # expired key frees room
+        time.sleep(0.05)
+        self.assertTrue(c.set(4, 'x' * 100))
+        self.assertEqual(['2', '3', '4'], sorted(c.data))
+        self.assertEqual(3 * (key_size + 100), c.bytes)
+        self.assertIsNone(c.get(1))
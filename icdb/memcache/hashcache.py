@@ -18,18 +18,51 @@ class HashCache(object):
 
     """
     HashCache is simple mem-storage for key-value
-    Implements hash tables for fast search, o(ln n)
-    Appending is slow
+    Implements hash table for fast search, o(1)
+    Appending and deleting are o(1) too
+    Sorted by hash list of records is built on demand and cached
     """
 
     def __init__(self):
         '''
         internal:
-        hashtable (ht) is list of tuples(hash, key, value)
-        ht_count - size of list
+        table is dict(hash: (key, value))
+        sorted_ht is cached list of tuples(hash, key, value), sorted by hash,
+            None if table was changed after it was built
         '''
-        self.ht = list()
-        self.ht_count = 0
+        self.table = dict()
+        self.sorted_ht = None
+
+    @classmethod
+    def from_items(cls, items):
+        '''
+        Builds HashCache from iterable of tuples(key, value) at once
+        Keys are hashed in one loop and records are sorted once - o(n ln n)
+        If key repeats, last value wins
+        '''
+        hc = cls()
+        table = hc.table
+        for key, value in items:
+            if type(key) is not str:
+                key = str(key)
+            table[md5(key.encode()).digest()] = (key, value)
+        hc.sorted_ht = sorted((hash, key, value) for hash, (key, value)
+                              in table.items())
+        return hc
+
+    @property
+    def ht(self):
+        ''' list of tuples(hash, key, value), sorted by hash '''
+        if self.sorted_ht is None:
+            # hashes are unique, so only they are compared
+            self.sorted_ht = sorted((hash, key, value) for hash, (key, value)
+                                    in self.table.items())
+        return self.sorted_ht
+
+    @property
+    def ht_count(self):
+        ''' count of records '''
+        return len(self.table)
 
     def __getitem__(self, key):
         if type(key) is not str:
@@ -59,50 +92,23 @@ class HashCache(object):
 
     def __set__(self, hash, key, value):
         '''
-        Only appends k-v pair
-        If update needed then search and delete key outside
-        append - o(n)
-        sorted - o(?)
+        Creates or updates record - o(1)
         '''
-        # append record to list
-        self.ht.append((hash, key, value))
-        self.ht_count = self.ht_count + 1
-        # sort it
-        self.ht = sorted(self.ht)
-        pass
+        self.table[hash] = (key, value)
+        self.sorted_ht = None
 
     def __get__(self, hash):
-        def search(begin, end):
-            # print('hs=%s, he=%s, h=%s' % (self.ht[begin][0], self.ht[end][0], hash))
-            if end - begin < 2:
-                if self.ht[begin][0] == hash:
-                    return self.ht[begin]
-                if self.ht[end][0] == hash:
-                    return self.ht[end]
-                raise KeyError
-            idx = int(begin + (end - begin) / 2)
-            # print('b=%s, idx=%s, e=%s'%(begin,idx,end))
-            if self.ht[idx][0] == hash:
-                return self.ht[idx]
-            if hash < self.ht[idx][0]:
-                return search(begin, idx)
-            else:
-                return search(idx, end)
-        # if empty
-        if self.ht_count == 0:
-            raise KeyError
-        # get first
-        if hash < self.ht[0][0]:
-            raise KeyError
-        # get last
-        if hash > self.ht[self.ht_count - 1][0]:
-            raise KeyError
-        # search and return
-        return search(0, self.ht_count - 1)
-        pass
+        '''
+        Returns tuple(hash, key, value) - o(1)
+        If not found raises KeyError
+        '''
+        key, value = self.table[hash]
+        return (hash, key, value)
 
     def __delete__(self, hash):
-        tp = self.__get__(hash)
-        self.ht.remove(tp)
-        self.ht_count = self.ht_count - 1
-        pass
+        '''
+        Deletes record - o(1)
+        If not found raises KeyError
+        '''
+        del self.table[hash]
+        self.sorted_ht = None
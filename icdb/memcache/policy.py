@@ -0,0 +1,401 @@
+# -------------------------------#
+# Written by icoz, 2013          #
+# email: icoz.vt at gmail.com    #
+# License: GPL v3                #
+# -------------------------------#
+
+"""
+Eviction policies of CacheMW
+Policy keeps keys of cache (not values) and chooses which one to delete:
+  hit(key) - key in cache was used (get or set of existing key)
+  insert(key) - new key is stored in cache
+  remove(key) - key is deleted from cache
+  evict() - forgets key to be deleted from cache and returns it
+Policy is created with limit of cache, it is used to size parts of it.
+
+Policies:
+  lru - least recently used
+  tinylfu - W-TinyLFU: small LRU window, then segmented LRU main part;
+      key from window gets to main part only if it was used more often
+      than victim of main part, frequency is kept in count-min sketch
+  arc - adaptive replacement cache: recent and frequent LRU lists with
+      ghost lists of their deleted keys, which move bound between them
+  2q - new keys in FIFO, keys used again after they left it go to LRU
+All operations are O(1).
+"""
+
+from collections import OrderedDict
+import random
+from unittest import TestCase
+
+
+class LRUPolicy(object):
+
+    """ Deletes least recently used key """
+
+    def __init__(self, limit):
+        # keys, least recently used first
+        self.keys = OrderedDict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def hit(self, key):
+        self.keys.move_to_end(key)
+
+    def insert(self, key):
+        self.keys[key] = None
+
+    def remove(self, key):
+        del self.keys[key]
+
+    def evict(self):
+        return self.keys.popitem(last=False)[0]
+
+
+# byte -> byte >> 1, to halve counters of sketch at once
+HALVE = bytes(i >> 1 for i in range(256))
+
+
+class CountMinSketch(object):
+
+    """
+    Approximate frequency of keys, DEPTH rows of width 4-bit-like counters
+    (up to MAX). After sample additions all counters are halved, so old
+    popularity fades.
+    """
+    DEPTH = 4
+    MAX = 15
+
+    def __init__(self, width, sample):
+        self.width = 16
+        while self.width < width:
+            self.width <<= 1
+        self.mask = self.width - 1
+        self.table = bytearray(self.width * self.DEPTH)
+        self.additions = 0
+        self.sample = max(1, int(sample))
+
+    def __indexes__(self, key):
+        """ internal. Positions of counters of key, one per row """
+        h = hash(key)
+        h2 = (h >> 17) | 1
+        mask = self.mask
+        width = self.width
+        return [((h + i * h2) & mask) + i * width for i in range(self.DEPTH)]
+
+    def add(self, key):
+        table = self.table
+        top = self.MAX
+        # __indexes__ inlined, add is called on every hit
+        h = hash(key)
+        h2 = (h >> 17) | 1
+        mask = self.mask
+        width = self.width
+        for i in range(self.DEPTH):
+            j = ((h + i * h2) & mask) + i * width
+            if table[j] < top:
+                table[j] += 1
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.table = table.translate(HALVE)
+            self.additions //= 2
+
+    def estimate(self, key):
+        table = self.table
+        return min(table[i] for i in self.__indexes__(key))
+
+
+class TinyLFUPolicy(object):
+
+    """
+    W-TinyLFU: new keys go to LRU window of WINDOW part of limit, keys
+    leaving window go to probation part of main segmented LRU, keys used
+    in probation go to protected part (PROTECTED of main). On evict the
+    key which has left window last (candidate, or newest key of probation)
+    and least recently used key of probation (victim) are compared by
+    frequency, the less used one goes.
+    Sketch has WIDTH counters per row for each key of limit, so few keys
+    share counters, and is halved after SAMPLE additions per key of limit.
+    """
+    WINDOW = 0.01
+    PROTECTED = 0.8
+    WIDTH = 4
+    SAMPLE = 10
+
+    def __init__(self, limit):
+        self.window_size = max(1, int(limit * self.WINDOW))
+        self.protected_size = max(1, int((limit - self.window_size) * self.PROTECTED))
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        # key moved from window to probation, not admitted yet
+        self.candidate = None
+        self.sketch = CountMinSketch(limit * self.WIDTH, limit * self.SAMPLE)
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def hit(self, key):
+        self.sketch.add(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.protected:
+            self.protected.move_to_end(key)
+        else:
+            del self.probation[key]
+            self.protected[key] = None
+            if len(self.protected) > self.protected_size:
+                k, v = self.protected.popitem(last=False)
+                self.probation[k] = None
+
+    def insert(self, key):
+        self.sketch.add(key)
+        self.window[key] = None
+        if len(self.window) > self.window_size:
+            k, v = self.window.popitem(last=False)
+            self.probation[k] = None
+            self.candidate = k
+
+    def remove(self, key):
+        for keys in (self.window, self.probation, self.protected):
+            if key in keys:
+                del keys[key]
+                return
+
+    def evict(self):
+        probation = self.probation
+        if probation:
+            victim = next(iter(probation))
+            candidate = self.candidate
+            self.candidate = None
+            if candidate is None or candidate not in probation:
+                # more keys are evicted at once, newest one of probation
+                # is the least proven
+                candidate = next(reversed(probation))
+            if candidate == victim or self.sketch.estimate(candidate) > self.sketch.estimate(victim):
+                del probation[victim]
+                return victim
+            del probation[candidate]
+            return candidate
+        if self.protected:
+            return self.protected.popitem(last=False)[0]
+        return self.window.popitem(last=False)[0]
+
+
+class ARCPolicy(object):
+
+    """
+    Adaptive replacement cache: t1 keeps keys used once, t2 keys used
+    more; b1 and b2 keep keys deleted from them (ghosts). Insert of key
+    from b1 makes t1 target size p bigger, from b2 - smaller.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def hit(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        else:
+            self.t2.move_to_end(key)
+
+    def insert(self, key):
+        b1 = self.b1
+        b2 = self.b2
+        if key in b1:
+            self.p = min(self.limit, self.p + max(len(b2) // len(b1), 1))
+            del b1[key]
+            self.t2[key] = None
+        elif key in b2:
+            self.p = max(0, self.p - max(len(b1) // len(b2), 1))
+            del b2[key]
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+        self.__trim__()
+
+    def remove(self, key):
+        if key in self.t1:
+            del self.t1[key]
+        else:
+            del self.t2[key]
+
+    def evict(self):
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            key = self.t1.popitem(last=False)[0]
+            self.b1[key] = None
+        else:
+            key = self.t2.popitem(last=False)[0]
+            self.b2[key] = None
+        self.__trim__()
+        return key
+
+    def __trim__(self):
+        """ internal. Forgets oldest ghosts, t1 and b1 keep at most limit keys, all lists 2 * limit """
+        b1 = self.b1
+        b2 = self.b2
+        while b1 and len(self.t1) + len(b1) > self.limit:
+            b1.popitem(last=False)
+        while b2 and len(self.t1) + len(self.t2) + len(b1) + len(b2) > 2 * self.limit:
+            b2.popitem(last=False)
+
+
+class TwoQPolicy(object):
+
+    """
+    2Q: new keys go to FIFO a1in of KIN part of limit, keys leaving it
+    are remembered in a1out (KOUT part of limit). Insert of key from
+    a1out puts it to LRU am.
+    """
+    KIN = 0.25
+    KOUT = 0.5
+
+    def __init__(self, limit):
+        self.kin = max(1, int(limit * self.KIN))
+        self.kout = max(1, int(limit * self.KOUT))
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+
+    def __len__(self):
+        return len(self.a1in) + len(self.am)
+
+    def hit(self, key):
+        # a1in is FIFO, hits do not move keys in it
+        if key in self.am:
+            self.am.move_to_end(key)
+
+    def insert(self, key):
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = None
+        else:
+            self.a1in[key] = None
+
+    def remove(self, key):
+        if key in self.a1in:
+            del self.a1in[key]
+        else:
+            del self.am[key]
+
+    def evict(self):
+        if len(self.a1in) > self.kin or not self.am:
+            key = self.a1in.popitem(last=False)[0]
+            self.a1out[key] = None
+            if len(self.a1out) > self.kout:
+                self.a1out.popitem(last=False)
+            return key
+        return self.am.popitem(last=False)[0]
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'tinylfu': TinyLFUPolicy,
+    'arc': ARCPolicy,
+    '2q': TwoQPolicy,
+}
+
+
+def policy_class(policy):
+    """
+    returns class (or factory) of policy by name, or policy itself if it
+    is callable(limit)
+    raises ValueError for unknown name
+    """
+    if callable(policy):
+        return policy
+    if policy not in POLICIES:
+        raise ValueError('unknown policy %r, use one of %s' % (policy, sorted(POLICIES)))
+    return POLICIES[policy]
+
+
+class PolicyTest(TestCase):
+    # parts of each policy, which keep keys of cache
+    PARTS = {
+        LRUPolicy: ('keys',),
+        TinyLFUPolicy: ('window', 'probation', 'protected'),
+        ARCPolicy: ('t1', 't2'),
+        TwoQPolicy: ('a1in', 'am'),
+    }
+
+    def keys(self, policy):
+        keys = []
+        for part in self.PARTS[type(policy)]:
+            keys.extend(getattr(policy, part))
+        return keys
+
+    def cache(self, policy, **kwargs):
+        from icdb.memcache.cache_mw import CacheMW
+        return CacheMW(policy=policy, **kwargs)
+
+    def test_keys_match_data(self):
+        rnd = random.Random(1)
+        for name in sorted(POLICIES):
+            c = self.cache(name, limit=50, on_limit_cleanup=5, max_bytes=4000, sizeof=len)
+            for i in range(5000):
+                key = rnd.randint(0, 200)
+                op = rnd.random()
+                if op < 0.5:
+                    c.get(key)
+                elif op < 0.8:
+                    c.set(key, 'x' * rnd.randint(1, 100))
+                else:
+                    c.delete(key)
+                keys = self.keys(c.policy)
+                self.assertEqual(len(keys), len(set(keys)), name)
+                self.assertEqual(set(c.data), set(keys), name)
+                self.assertLessEqual(len(c.data), 50, name)
+
+    def test_ghosts_bounded(self):
+        rnd = random.Random(2)
+        arc = ARCPolicy(100)
+        two_q = TwoQPolicy(100)
+        for policy in (arc, two_q):
+            keys = set()
+            for i in range(20000):
+                key = rnd.randint(0, 1000)
+                if key in keys:
+                    policy.hit(key)
+                    continue
+                policy.insert(key)
+                keys.add(key)
+                if len(policy) > 100:
+                    keys.remove(policy.evict())
+        self.assertLessEqual(len(arc.t1) + len(arc.b1), 100)
+        self.assertLessEqual(len(arc.t1) + len(arc.t2) + len(arc.b1) + len(arc.b2), 200)
+        self.assertLessEqual(len(two_q.a1out), two_q.kout)
+
+    def test_policy_class(self):
+        self.assertIs(ARCPolicy, policy_class('arc'))
+        self.assertIs(LRUPolicy, policy_class(LRUPolicy))
+        self.assertRaises(ValueError, policy_class, 'mru')
+        self.assertRaises(ValueError, self.cache, 'mru')
+
+    def test_scan_resistance(self):
+        hits = dict()
+        for name in ('lru', 'tinylfu', 'arc'):
+            c = self.cache(name, limit=100, on_limit_cleanup=1)
+            hot = ['hot %i' % i for i in range(50)]
+            for round in range(8):
+                for key in hot:
+                    if c.get(key) is None:
+                        c.set(key, key)
+            # cold keys are used once each
+            for i in range(300):
+                if c.get('cold %i' % i) is None:
+                    c.set('cold %i' % i, i)
+            hits[name] = sum(1 for key in hot if c.get(key) is not None)
+        self.assertEqual(0, hits['lru'])
+        # sketch is approximate, a cold key may share counters with hot ones
+        self.assertGreaterEqual(hits['tinylfu'], 45)
+        self.assertEqual(50, hits['arc'])
@@ -0,0 +1,59 @@
+# -------------------------------#
+# Written by icoz, 2013          #
+# email: icoz.vt at gmail.com    #
+# License: GPL v3                #
+# -------------------------------#
+
+"""
+Compression of values, shared by Storage and FileStorage
+
+Flags of record:
+  bit 0 - record is deleted
+  bits 1-2 - codec of value: 0 - none, 1 - zlib, 2 - lzma, 3 - bz2
+"""
+
+import bz2
+import lzma
+import zlib
+
+FLAG_DELETED = 1
+CODEC_SHIFT = 1
+CODEC_MASK = 3 << CODEC_SHIFT
+
+# name -> id kept in flags
+CODECS = {'zlib': 1, 'lzma': 2, 'bz2': 3}
+# id -> (compress, decompress)
+FUNCTIONS = {
+    1: (zlib.compress, zlib.decompress),
+    2: (lzma.compress, lzma.decompress),
+    3: (bz2.compress, bz2.decompress),
+}
+
+
+def check_codec(codec):
+    """ raises ValueError, if codec is not None and unknown """
+    if codec is not None and codec not in CODECS:
+        raise ValueError('unknown codec %r, use one of %s' % (codec, sorted(CODECS)))
+
+
+def encode(value, codec, threshold):
+    """
+    Compresses bytes value by codec, if value is not shorter than threshold
+    and becomes shorter after compression
+    returns (flags, bytes)
+    """
+    if codec is None or len(value) < threshold:
+        return 0, value
+    id = CODECS[codec]
+    data = FUNCTIONS[id][0](value)
+    if len(data) >= len(value):
+        return 0, value
+    return id << CODEC_SHIFT, data
+
+
+def decode(data, flags):
+    """ returns bytes of value stored as data with flags """
+    id = (flags & CODEC_MASK) >> CODEC_SHIFT
+    if id == 0:
+        return data
+    return FUNCTIONS[id][1](data)
@@ -9,16 +9,26 @@ Struct of FileStorage
 ---------------------
 FileStorage keeps data in 3 types of files: .idx, .key, .value
 .idx - index for keeping hash, key-offset, value-offset
+.journal - changes of index made after .idx was saved
+.kdx - keys in sorted order, only if FileStorage is opened with ordered=True
 .key - file to save keys (binary)
 .value - file to save values (binary)
 
 Limits
 ------
 Key size is max 2^32 bytes
-Value size is max 2^40 bytes
+Value size and offsets are max 2^64 bytes
+(version 1 of .key-file: offsets and sizes are max 2^31)
+
+Files of older versions are read and appended in their own version,
+use icdb.storage.migrate to convert them.
 
 .idx struct
 -----------
+Version 3 is written, see icdb.storage.index_file. It keeps hashes and is
+searched in place, so on open index is only mapped. Version 2 is mapped
+the same way.
+Version 1 is still read:
 Header:
   magic, 4 byte = 0x720AE06A, b'\x6a\xe0\x0a\x72'
   version id, 4 byte = 0x00000001
@@ -27,36 +37,98 @@ Header:
 
   records, (records count)*sizeof(Record), sorted by hash
 Record:
-  #hash, 16 bytes, md5(key)
   key_offset, 4 bytes
   key_size, 4 bytes = count of bytes
   value_offset, 4 bytes = count of blocks(256-bytes) to skip
-  value_size, 4 bytes = count of 256-bytes
+  value_size, 4 bytes = count of bytes
 
 .key struct
 -----------
 Contents records of variable size
-Record:
+Record, version 2 (little-endian):
+  magic, 8 byte = b'\x50\x0a\x6f\x70\xf2\x52\x56\xad'
+  key_size, 4 bytes = count of bytes
+  flags, 4 byte = bit 0 - deleted, bits 1-2 - codec of value
+    (see icdb.storage.codec)
+  value_offset, 8 bytes = count of bytes to skip
+  value_size, 8 bytes = count of bytes
+  key, bytes[]
+Record, version 1:
   magic, 8 byte = b'\x50\x0a\x6f\x70\xf2\x52\x55\xad'
   key_size, 4 bytes = count of bytes
   flags, 4 byte = 0 - ok, non 0 - deleted
   value_offset, 4 bytes = count of blocks(256-bytes) to skip
-  value_size, 4 bytes = count of 256-bytes
+  value_size, 4 bytes = count of bytes
   key, bytes[]
 
 .value struct
 -------------
 Contents records of variable size
 Record:
-  value, bytes[], aligned to 256 bytes
+  value, bytes[], compressed if codec is set in flags of key record
+Values are placed by blocks of value_block bytes (256 by default, 1 - no
+alignment): value, which fits into the rest of current block, is packed
+there, others start at block boundary. Gaps are filled with zeros.
+Values of version 1 files are always aligned to 256 bytes.
+
+Durability
+----------
+Writes are appended to buffered files, what happens next is chosen by
+durability policy:
+  'none' - nothing, buffers go to OS when full, on read or on close
+  'flush-per-batch' - buffers are flushed after every set, delete or
+    set_many (default)
+  'fsync-interval' - background thread flushes and fsyncs files every
+    fsync_interval seconds
+  'fsync-per-write' - set, delete and set_many return after their data
+    is fsynced. Background thread does it for all waiting writers with
+    one fsync (group commit)
+sync() flushes and fsyncs files at once for any policy.
+
+Index journal
+-------------
+Every change of index is appended to .journal (see icdb.storage.journal),
+it is flushed and synced together with .key and .value. When journal
+grows over checkpoint_size, index is saved to .idx (with bloom filter to
+.bloom) and journal is cleared; close only syncs journal, so it costs
+nothing for large index. On open index is .idx
+with journal replayed over it and records of .key-file appended after
+last journaled one, so nothing is rebuilt after crash. Index is built
+from .key-file only if .idx or journal is absent or broken.
+
+Ordered index
+-------------
+With ordered=True keys are also kept in order: .kdx (see
+icdb.storage.key_index) is saved together with .idx, keys changed after
+that are kept in memory and merged with it on the fly. scan(start, end)
+and prefix(p) stream pairs in order of keys and read values by get_many.
+If .kdx is absent or does not match .idx, it is built from .key-file.
+
+Compress
+--------
+compress writes live records to .key.compress and .value.compress, then
+replaces .value and .key by them (in this order) and writes new .idx.
+On open, single .key.compress is taken as new key-file, other leftovers
+of interrupted compress are removed.
 """
 
+from bisect import bisect_left
+import csv
 from hashlib import md5
-from io import SEEK_END, SEEK_SET
+from itertools import islice
+from io import SEEK_END
+import json
 import os
 import struct
+import threading
 from unittest import TestCase
+import weakref
 from icdb.memcache.hashcache import HashCache
+from icdb.memcache.bloomfilter import BloomFilter
+from icdb.storage.codec import FLAG_DELETED, check_codec, decode, encode
+from icdb.storage.index_file import IndexFile
+from icdb.storage.journal import IndexJournal
+from icdb.storage.key_index import KeyIndex
 
 
 def hash_md5(info):
@@ -66,245 +138,1127 @@ def hash_md5(info):
     return m.digest()
 
 
+def key_file_version(filename):
+    """ Returns version of key-file by its first record """
+    try:
+        with open(filename, 'rb') as fin:
+            magic = fin.read(8)
+    except FileNotFoundError:
+        magic = b''
+    for version, (key_magic, head, block) in FileStorage.KEY_FORMATS.items():
+        if magic == key_magic:
+            return version
+    if magic == b'':
+        return FileStorage.KEY_VERSION
+    # broken first record, files without version mark are the oldest
+    return 1
+
+
+def key_records(fin, version, deleted=False, buffer_size=1024 * 1024):
+    """
+    Generator for records of key-file opened as fin, reads it by chunks
+    from current position of fin
+    Jumps from record to record using key_size,
+    magic number is searched only to resync after corrupted record
+    If deleted is True, then deleted records are yielded too
+    raises: (flags, key_size, value_offset, value_size, key, key_offset)
+    value_offset is in bytes, key is bytes
+    """
+    magic, head, block = FileStorage.KEY_FORMATS[version]
+    header_size = len(magic) + head.size
+    buf = b''
+    # file offset of buf[0]
+    base = fin.tell()
+    pos = 0
+    # bytes needed in buf from pos
+    need = header_size
+    eof = False
+    while True:
+        if len(buf) - pos < need and not eof:
+            chunk = fin.read(max(buffer_size, need))
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            base += pos
+            pos = 0
+            continue
+        if len(buf) - pos < header_size:
+            break
+        if buf.startswith(magic, pos):
+            key_size, flags, value_offset, value_size = head.unpack_from(buf, pos + len(magic))
+            end = pos + header_size + key_size
+            if key_size >= 0 and end <= len(buf):
+                if not flags & FLAG_DELETED or deleted:
+                    yield (flags, key_size, value_offset * block, value_size,
+                           buf[pos + header_size:end], base + pos)
+                pos = end
+                need = header_size
+                continue
+            if key_size >= 0 and not eof:
+                # record is not read till end
+                need = header_size + key_size
+                continue
+        need = header_size
+        # broken record, resync on next magic number
+        found = buf.find(magic, pos + 1)
+        if found != -1:
+            pos = found
+        elif eof:
+            break
+        else:
+            # magic can be split between chunks, keep its head
+            pos = max(pos + 1, len(buf) - len(magic) + 1)
+
+
+def pairs_from_file(filename, format=None):
+    """
+    Generator for (key, value) read from file for FileStorage.bulk_load
+    format - 'csv' (key and value are first two columns) or 'jsonl'
+    (one JSON per line: [key, value] or {"key": ..., "value": ...}),
+    by default it is taken from extension of filename
+    Values, which are not strings, are kept as JSON
+    """
+    if format is None:
+        format = os.path.splitext(filename)[1].lstrip('.').lower()
+        if format == 'json':
+            format = 'jsonl'
+    if format == 'csv':
+        with open(filename, newline='', encoding='utf-8') as fin:
+            for row in csv.reader(fin):
+                if row:
+                    yield row[0], row[1]
+    elif format == 'jsonl':
+        with open(filename, encoding='utf-8') as fin:
+            for line in fin:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    key, value = item['key'], item['value']
+                else:
+                    key, value = item
+                if not isinstance(value, str):
+                    value = json.dumps(value)
+                yield key, value
+    else:
+        raise ValueError('unknown format %r, use csv or jsonl' % format)
+
+
+def commit_loop(ref, cond, timeout):
+    """
+    Body of group commit thread of FileStorage, ref is weak reference to it
+    Waits for writes (or timeout) and syncs all of them at once
+    Ends, when storage is closed or collected
+    """
+    while True:
+        with cond:
+            fs = ref()
+            if fs is None or fs.closed:
+                return
+            pending = fs.synced_seq < fs.write_seq
+            # storage must be collectable, while thread waits
+            del fs
+            if timeout is not None or not pending:
+                cond.wait(timeout)
+        fs = ref()
+        if fs is None or fs.closed:
+            return
+        if fs.synced_seq < fs.write_seq:
+            fs.sync()
+        del fs
+
+
 class FileStorage(object):
     """
     FileStorage
     """
     KEY_MAGIC_NUMBER = b'\x50\x0a\x6f\x70\xf2\x52\x55\xad'
+    KEY_MAGIC_NUMBER_V2 = b'\x50\x0a\x6f\x70\xf2\x52\x56\xad'
+    # key-file versions: (magic, struct of record after magic,
+    #   size of value_offset unit in bytes)
+    KEY_FORMATS = {
+        1: (KEY_MAGIC_NUMBER, struct.Struct('iiii'), 256),
+        2: (KEY_MAGIC_NUMBER_V2, struct.Struct('<IIQQ'), 1),
+    }
+    # version of new key-files
+    KEY_VERSION = 2
     IDX_MAGIC_NUMBER = b'\x6a\xe0\x0a\x72'
+    # minimal capacity of bloom filter
+    BLOOM_CAPACITY = 1000
+    # size of copy buffer used by compress
+    COMPRESS_BUFFER_SIZE = 1024 * 1024
+    # files smaller than this are not compressed automatically
+    COMPRESS_MIN_SIZE = 1024 * 1024
+    # default alignment of values
+    VALUE_BLOCK = 256
+    # values shorter than this are not compressed
+    CODEC_THRESHOLD = 64
+    DURABILITY = ('none', 'flush-per-batch', 'fsync-interval', 'fsync-per-write')
+    # seconds between fsyncs for 'fsync-interval'
+    FSYNC_INTERVAL = 0.1
+    # index is saved, when journal grows over this size
+    CHECKPOINT_SIZE = 4 * 1024 * 1024
+    # get_many reads values with gaps up to READ_GAP bytes between them
+    # by one read of at most READ_SIZE bytes
+    READ_GAP = 4096
+    READ_SIZE = 1024 * 1024
+    # scan reads values of this many keys at once
+    SCAN_BATCH = 256
+    # size of write buffers of bulk_load
+    BULK_BUFFER_SIZE = 4 * 1024 * 1024
 
-    def __init__(self, filename='test.icdb'):
+    def __init__(self, filename='test.icdb', bloom_fp_rate=0.01, compress_ratio=None,
+                 value_block=None, codec=None, codec_threshold=None,
+                 durability='flush-per-batch', fsync_interval=None, checkpoint_size=None,
+                 ordered=False):
+        """
+        bloom_fp_rate - false positive rate of bloom filter, which rejects
+        keys absent in index without searching it
+        compress_ratio - if set, compress is started in background thread,
+        when space_amplification() reaches it
+        value_block - size of block in value-file, see .value struct
+        codec - 'zlib', 'lzma' or 'bz2' to compress values, None - do not
+        codec_threshold - values shorter than this are stored as is
+        durability - policy of flushes and fsyncs, see Durability above
+        fsync_interval - seconds between fsyncs for 'fsync-interval'
+        checkpoint_size - size of index journal to save index at
+        ordered - keep index of keys in order for scan and prefix
+        """
         # super(FileStorage, self).__init__()
+        check_codec(codec)
+        if durability not in self.DURABILITY:
+            raise ValueError('unknown durability %r, use one of %s' % (durability, self.DURABILITY))
+        self.durability = durability
+        self.codec = codec
+        if codec_threshold is None:
+            codec_threshold = self.CODEC_THRESHOLD
+        self.codec_threshold = codec_threshold
         self.filename = filename
+        self.compress_ratio = compress_ratio
+        if value_block is None:
+            value_block = self.VALUE_BLOCK
+        if value_block < 1:
+            raise ValueError('value_block must be 1 or more, got %r' % value_block)
+        self.value_block = value_block
+        # guards writes, index and files switch in compress
+        self.lock = threading.RLock()
+        self.compressing = False
+        self.compress_thread = None
+        # size of live records in files, counted on demand
+        self.live_size = None
+        self.__recover_compress__()
+        # index is saved index (IndexFile, searched on disk) and
+        # HashCache with changes made after it was loaded,
+        # there index_info is None for deleted keys
+        self.base = None
         self.index = HashCache()
-        self.value_file = open(filename + '.value', 'ab')
-        self.key_file = open(filename + '.key', 'ab')
-        if os.path.exists(self.filename + '.idx'):
+        # ordered index is KeyIndex and dict(key: True if set, False if
+        # deleted) with changes made after it was loaded
+        self.ordered = ordered
+        self.keys_base = None
+        self.keys_delta = dict()
+        # sorted items of keys_delta, None if it was changed
+        self.keys_sorted = None
+        self.bloom_fp_rate = bloom_fp_rate
+        if checkpoint_size is None:
+            checkpoint_size = self.CHECKPOINT_SIZE
+        self.checkpoint_size = checkpoint_size
+        self.journal = IndexJournal(filename + '.journal')
+        self.__open_files__()
+        try:
             self.load_index()
-        else:
+        except (FileNotFoundError, ValueError, IndexError):
             self.build_index()
+        else:
+            self.__load_bloom__()
+            if self.journal.size() >= self.checkpoint_size:
+                self.save_index()
+        # writes are counted, commit thread syncs them up to write_seq
+        self.write_seq = 0
+        self.synced_seq = 0
+        self.closed = False
+        self.commit_cond = threading.Condition()
+        self.commit_thread = None
+        if durability in ('fsync-interval', 'fsync-per-write'):
+            timeout = None
+            if durability == 'fsync-interval':
+                timeout = fsync_interval if fsync_interval is not None else self.FSYNC_INTERVAL
+            self.commit_thread = threading.Thread(
+                target=commit_loop, args=(weakref.ref(self), self.commit_cond, timeout), daemon=True)
+            self.commit_thread.start()
 
     def __del__(self):
+        if not hasattr(self, 'closed'):
+            # __init__ has failed
+            return
+        with self.commit_cond:
+            self.closed = True
+            self.commit_cond.notify_all()
+        # index is not saved: journal keeps changes, checkpoint is made
+        # when it grows over checkpoint_size
+        if self.durability != 'none':
+            self.sync()
+        self.journal.close()
+        self.__close_files__()
+
+    def __open_files__(self):
+        """ internal
+        Opens files: buffered for appends, long-lived fds for positional reads
+        Call it again after files were replaced (by compress)
+        """
+        self.key_version = key_file_version(self.filename + '.key')
+        self.key_magic, self.key_head, self.key_block = self.KEY_FORMATS[self.key_version]
+        self.key_header_size = len(self.key_magic) + self.key_head.size
+        self.value_file = open(self.filename + '.value', 'ab')
+        self.key_file = open(self.filename + '.key', 'ab')
+        self.value_fd = os.open(self.filename + '.value', os.O_RDONLY)
+        # flags of written records are updated in place by this fd
+        self.key_fd = os.open(self.filename + '.key', os.O_RDWR)
+
+    def __close_files__(self):
+        """ internal. Closes files opened by __open_files__ """
         self.value_file.close()
         self.key_file.close()
-        self.build_index()
-        self.save_index()
+        os.close(self.value_fd)
+        os.close(self.key_fd)
 
     def __setitem__(self, key, value):
-        value_offset, value_size = self.__save_value_record__(value)
-        key_offset = self.__save_key_record__(key, value_offset, value_size)
+        with self.lock:
+            self.__set_record__(key, value)
+            seq = self.__end_batch__()
+        self.__commit__(seq)
+
+    def set_many(self, pairs):
+        """
+        create or update many pairs, they are one batch for durability policy
+        pairs is dict or iterable of (key, value)
+        """
+        if isinstance(pairs, dict):
+            pairs = pairs.items()
+        with self.lock:
+            for key, value in pairs:
+                self.__set_record__(key, value)
+            seq = self.__end_batch__()
+        self.__commit__(seq)
+
+    def __set_record__(self, key, value):
+        """ internal. Appends records for pair and updates index, called under lock """
+        value_offset, value_size, flags = self.__save_value_record__(value)
+        key_offset = self.__save_key_record__(key, value_offset, value_size, flags)
+        self.bloom.add(key)
         # update index
         # if we have such key, then del it!
-        i_key_offset, *rest = self.__get_from_index__(key)
+        i_key_offset, i_value_offset, i_value_size, i_flags = self.__get_from_index__(key)
+        key_size = len(str(key).encode())
         if i_key_offset is not None:
             self.index.delete(key)
-            self.key_file.seek(i_key_offset + 12, SEEK_SET)
-            self.key_file.write(b'\x01')
-        self.__put_to_index__(key, key_offset, value_offset, value_size)
+            self.__mark_deleted__(i_key_offset)
+            if self.live_size is not None:
+                self.live_size -= self.__record_space__(key_size, i_value_size)
+        self.__put_to_index__(key, key_offset, value_offset, value_size, flags)
+        if self.live_size is not None:
+            self.live_size += self.__record_space__(key_size, value_size)
+        if self.bloom.is_full():
+            self.__build_bloom__()
+        self.__auto_compress__()
+
+    def __end_batch__(self):
+        """ internal
+        Called under lock after batch of writes, returns its number for __commit__
+        """
+        self.write_seq += 1
+        if self.journal.size() >= self.checkpoint_size:
+            self.save_index()
+        if self.durability == 'flush-per-batch':
+            self.__flush__()
+        return self.write_seq
+
+    def __commit__(self, seq):
+        """ internal. Waits till batch seq is fsynced, if policy says so """
+        if self.durability != 'fsync-per-write':
+            return
+        with self.commit_cond:
+            self.commit_cond.notify_all()
+            while self.synced_seq < seq and not self.closed:
+                self.commit_cond.wait()
+
+    def __flush__(self):
+        """ internal. Passes buffered records to OS """
+        self.value_file.flush()
+        self.key_file.flush()
+        self.journal.flush()
+
+    def sync(self):
+        """
+        Flushes and fsyncs .key, .value and .journal files
+        Writers waiting for their fsync are released
+        """
+        with self.lock:
+            self.__flush__()
+            seq = self.write_seq
+            # compress can close files, while fsync runs without lock
+            fds = [os.dup(self.key_file.fileno()), os.dup(self.value_file.fileno()),
+                   os.dup(self.journal.fileno())]
+        try:
+            for fd in fds:
+                os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        with self.commit_cond:
+            if seq > self.synced_seq:
+                self.synced_seq = seq
+            self.commit_cond.notify_all()
 
     def __getitem__(self, key):
-        # find in index
-        key_offset, value_offset, value_size = self.__get_from_index__(key)
-        if key_offset is None:
-            # if not in index, then search on disk
-            for flags, key_size, value_offset, value_size, k, key_offset in self.__keys__():
-                if k == key:
-                    break
-                    # if no such key in key-file, then return None
-            if k != key:
+        with self.lock:
+            # bloom filter knows all keys ever set, most misses end here
+            if key not in self.bloom:
+                return None
+            # index has all keys of key-file, deleted ones are marked in it
+            key_offset, value_offset, value_size, flags = self.__get_from_index__(key)
+            if key_offset is None:
                 return None
-        with open(self.filename + '.value', 'rb') as vfile:
-            vfile.seek(value_offset * 256)
-            value = vfile.read(value_size)
-        return value.decode()
+            # files grow only by appends, so fd sees records passed to OS
+            self.value_file.flush()
+            value = os.pread(self.value_fd, value_size, value_offset)
+        return decode(value, flags).decode()
+
+    def bulk_load(self, pairs, format=None, buffer_size=None):
+        """
+        Loads many pairs at once, much faster than setting them one by one
+        pairs - dict, iterable of (key, value) or name of csv/jsonl file
+        (see pairs_from_file, format is passed to it)
+        Records are written through buffers of buffer_size bytes, only
+        index of loaded keys is kept in memory (last value of key wins),
+        then it is merged with index and saved as new .idx in one pass.
+        If pairs raise (e.g. bad line of file), files are cut back and
+        nothing is loaded.
+        Returns count of loaded pairs
+        """
+        if isinstance(pairs, str):
+            pairs = pairs_from_file(pairs, format)
+        elif isinstance(pairs, dict):
+            pairs = pairs.items()
+        if buffer_size is None:
+            buffer_size = self.BULK_BUFFER_SIZE
+        count = 0
+        with self.lock:
+            self.__flush__()
+            value_offset = value_start = self.value_file.tell()
+            key_offset = key_start = self.key_file.tell()
+            # hash -> (hash, key_offset, key_size, flags, value_offset, value_size)
+            new = dict()
+            # key records of keys repeated in pairs
+            repeated = []
+            # loaded keys, for ordered index
+            loaded = []
+            values = bytearray()
+            keys = bytearray()
+            magic, pack, block = self.key_magic, self.key_head.pack, self.key_block
+            try:
+                for key, value in pairs:
+                    key = str(key)
+                    k = key.encode()
+                    flags, v = encode(str(value).encode(), self.codec, self.codec_threshold)
+                    padding = self.__value_padding__(value_offset, len(v), block)
+                    if padding:
+                        values += bytes(padding)
+                        value_offset += padding
+                    values += v
+                    keys += magic
+                    keys += pack(len(k), flags, value_offset // block, len(v))
+                    keys += k
+                    hash = md5(k).digest()
+                    old = new.get(hash)
+                    if old is not None:
+                        repeated.append(old)
+                    new[hash] = (hash, key_offset, len(k), flags, value_offset, len(v))
+                    if self.ordered:
+                        loaded.append(key)
+                    value_offset += len(v)
+                    key_offset += self.key_header_size + len(k)
+                    count += 1
+                    if len(values) >= buffer_size or len(keys) >= buffer_size:
+                        # values first, key record must not point beyond .value
+                        self.value_file.write(values)
+                        del values[:]
+                        self.key_file.write(keys)
+                        del keys[:]
+                self.value_file.write(values)
+                self.key_file.write(keys)
+                self.__flush__()
+            except BaseException:
+                # written records are not in index, journal or bloom yet
+                self.__truncate_files__(key_start, value_start)
+                raise
+            for key in loaded:
+                self.keys_delta[key] = True
+            for hash, key_offset, key_size, flags, value_offset, value_size in repeated:
+                self.__mark_deleted__(key_offset)
+            self.keys_sorted = None
+            if self.bloom.count + len(new) > self.bloom.capacity:
+                self.__build_bloom__(new)
+            else:
+                for hash in new:
+                    self.bloom.add_hash(hash)
+            self.live_size = None
+            self.__checkpoint__(self.__merge_records__(sorted(new.values())))
+            seq = self.__end_batch__()
+        self.__commit__(seq)
+        return count
+
+    def __truncate_files__(self, key_size, value_size):
+        """ internal. Cuts .key and .value files back to given sizes """
+        for f, size in ((self.key_file, key_size), (self.value_file, value_size)):
+            f.truncate(size)
+            # appends go to end anyway, tell() must show it
+            f.seek(0, SEEK_END)
+
+    def __merge_records__(self, records):
+        """ internal
+        Generator for index records merged with records (sorted by hash),
+        which win. Records of index, which they replace, are marked deleted
+        """
+        records = iter(records)
+        index = self.__index_records__()
+        r = next(records, None)
+        i = next(index, None)
+        while r is not None or i is not None:
+            if r is None or (i is not None and i[0] < r[0]):
+                yield i
+                i = next(index, None)
+                continue
+            if i is not None and i[0] == r[0]:
+                self.__mark_deleted__(i[1])
+                i = next(index, None)
+            yield r
+            r = next(records, None)
+
+    def get_many(self, keys):
+        """
+        Returns list of values for keys, in order of keys (None for absent)
+        All keys are found in index first, then values are read in order
+        of their offsets, values lying close are read at once
+        """
+        keys = list(keys)
+        values = [None] * len(keys)
+        # (value_offset, value_size, flags, position in keys)
+        locations = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                key_offset, value_offset, value_size, flags = self.__get_from_index__(key)
+                if key_offset is not None:
+                    locations.append((value_offset, value_size, flags, i))
+            locations.sort()
+            self.value_file.flush()
+            first = 0
+            while first < len(locations):
+                start = locations[first][0]
+                end = start + locations[first][1]
+                last = first + 1
+                while last < len(locations):
+                    value_offset, value_size, flags, i = locations[last]
+                    if value_offset > end + self.READ_GAP or \
+                            max(end, value_offset + value_size) - start > self.READ_SIZE:
+                        break
+                    end = max(end, value_offset + value_size)
+                    last += 1
+                b = memoryview(os.pread(self.value_fd, end - start, start))
+                for value_offset, value_size, flags, i in locations[first:last]:
+                    pos = value_offset - start
+                    values[i] = str(decode(b[pos:pos + value_size], flags), 'utf-8')
+                first = last
+        return values
+
+    def scan(self, start=None, end=None):
+        """
+        Generator for (key, value) with start <= key < end, in order of keys
+        None means no bound. Needs FileStorage opened with ordered=True
+        """
+        if not self.ordered:
+            raise ValueError('FileStorage is opened without ordered index')
+        if start is not None:
+            start = str(start)
+        if end is not None:
+            end = str(end)
+        return self.__scan__(start, end)
+
+    def __scan__(self, start, end):
+        """ internal. Generator for scan """
+        with self.lock:
+            base = self.keys_base
+            delta = self.__sorted_delta__()
+        batch = []
+        for key in self.__ordered_keys__(start, base, delta):
+            if end is not None and key >= end:
+                break
+            batch.append(key)
+            if len(batch) >= self.SCAN_BATCH:
+                yield from self.__scan_values__(batch)
+                batch = []
+        yield from self.__scan_values__(batch)
+
+    def prefix(self, p):
+        """
+        Generator for (key, value) with keys starting with p, in order of keys
+        Needs FileStorage opened with ordered=True
+        """
+        p = str(p)
+        if p == '':
+            return self.scan()
+        if ord(p[-1]) == 0x10ffff:
+            return ((key, value) for key, value in self.scan(p) if key.startswith(p))
+        # keys with prefix p are less than p with next last char
+        return self.scan(p, p[:-1] + chr(ord(p[-1]) + 1))
+
+    def __scan_values__(self, keys):
+        """ internal. Generator for (key, value) of keys, which are still present """
+        for key, value in zip(keys, self.get_many(keys)):
+            if value is not None:
+                yield key, value
+
+    def __sorted_delta__(self):
+        """ internal. Sorted list of (key, is set) changed after ordered index was saved """
+        if self.keys_sorted is None:
+            self.keys_sorted = sorted(self.keys_delta.items())
+        return self.keys_sorted
+
+    def __ordered_keys__(self, start, base, delta):
+        """ internal
+        Generator for present keys not less than start, in order
+        Merges saved ordered index base with sorted list of changes delta
+        """
+        if base is not None:
+            base = base.iter_from(start)
+        else:
+            base = iter(())
+        if start is not None:
+            delta = islice(delta, bisect_left(delta, (start,)), None)
+        delta = iter(delta)
+        b = next(base, None)
+        d = next(delta, None)
+        while b is not None or d is not None:
+            if d is None or (b is not None and b < d[0]):
+                yield b
+                b = next(base, None)
+                continue
+            if b is not None and b == d[0]:
+                # changed after save
+                b = next(base, None)
+            key, present = d
+            if present:
+                yield key
+            d = next(delta, None)
+
+    def __load_keys__(self):
+        """ internal
+        Maps ordered index saved with .idx, builds it from key-file if it
+        does not match .idx
+        """
+        self.keys_delta = dict()
+        self.keys_sorted = None
+        try:
+            self.keys_base = KeyIndex(self.filename + '.kdx')
+            if self.base is None or len(self.keys_base) != len(self.base):
+                raise ValueError('key index does not match index')
+        except (FileNotFoundError, ValueError):
+            self.keys_base = None
+            for flags, key_size, value_offset, value_size, key, key_offset in self.__keys__():
+                self.keys_delta[key] = True
+
+    def __save_keys__(self):
+        """ internal
+        Saves ordered index with all changes, or removes it if it is not kept
+        """
+        if not self.ordered:
+            # it would not match .idx any more
+            try:
+                os.remove(self.filename + '.kdx')
+            except FileNotFoundError:
+                pass
+            return
+        KeyIndex.write(self.filename + '.kdx',
+                       self.__ordered_keys__(None, self.keys_base, self.__sorted_delta__()))
+        self.keys_base = KeyIndex(self.filename + '.kdx')
+        self.keys_delta = dict()
+        self.keys_sorted = None
 
     def delete(self, key):
-        # find in index
-        k_s = self.index[key]
-        # find record in file
-        if k_s is not None:
-            value_len, value_offset, key_offset = struct.unpack("iii", k_s)
+        with self.lock:
+            # find in index
+            key_offset, value_offset, value_size, flags = self.__get_from_index__(key)
+            if key_offset is None:
+                return
             # update flag
-            self.key_file.seek(key_offset + 12, SEEK_SET)
-            self.key_file.write(1)
-        pass
+            self.__mark_deleted__(key_offset)
+            self.__put_to_index__(key, key_offset, value_offset, value_size, flags | FLAG_DELETED)
+            if self.live_size is not None:
+                self.live_size -= self.__record_space__(len(str(key).encode()), value_size)
+            self.__auto_compress__()
+            seq = self.__end_batch__()
+        self.__commit__(seq)
+
+    def __mark_deleted__(self, key_offset):
+        """ internal. Sets flag deleted of key record at key_offset """
+        # record may still sit in write buffer
+        self.key_file.flush()
+        flags = os.pread(self.key_fd, 1, key_offset + 12)[0]
+        os.pwrite(self.key_fd, bytes([flags | FLAG_DELETED]), key_offset + 12)
+
+    def __record_space__(self, key_size, value_size):
+        """ internal. Bytes taken in files by record of given sizes """
+        if value_size >= self.value_block:
+            value_size += -value_size % self.value_block
+        return self.key_header_size + key_size + value_size
+
+    def space_amplification(self):
+        """
+        Ratio of size of .key and .value files to size of live records in
+        them. Grows with updates and deletes, compress drops it to about 1
+        """
+        with self.lock:
+            if self.live_size is None:
+                self.live_size = sum(self.__record_space__(key_size, value_size)
+                                     for hash, key_offset, key_size, flags, value_offset, value_size
+                                     in self.__index_records__())
+            size = self.key_file.tell() + self.value_file.tell()
+        return size / max(self.live_size, 1)
+
+    def __auto_compress__(self):
+        """ internal. Starts compress in background, if files grew too much """
+        if self.compress_ratio is None or self.compressing:
+            return
+        if self.key_file.tell() + self.value_file.tell() < self.COMPRESS_MIN_SIZE:
+            return
+        if self.space_amplification() >= self.compress_ratio:
+            self.compressing = True
+            self.compress_thread = threading.Thread(target=self.__compress__, daemon=True)
+            self.compress_thread.start()
 
-    def compress(self):
+    def compress(self, buffer_size=None):
         """
         Compress key and data files, removes deleted items
+        Live records are streamed to new .key and .value files (of current
+        version) through buffer of buffer_size bytes, then new files replace
+        old ones and index is saved. Reads and writes are not stopped while
+        records are copied, records written meanwhile are copied at the end.
+        Returns False if compress is already running
         """
-        # create new value and key files
-        nv = open(self.filename + ".nvalue", wb)
-        nk = open(self.filename + ".nkey", wb)
-        # in loop:
-        #   read old key
-        #   if not deleted save old value to new value
-        for flags, key_size, value_offset, value_size, key, key_offset in self.__keys__():
-            if flags == 0:
-                # get key record
-
-                # save key record
-                # get value record
-                # set value record
-                pass
-        pass
+        with self.lock:
+            if self.compressing:
+                return False
+            self.compressing = True
+        self.__compress__(buffer_size)
+        return True
+
+    def __compress__(self, buffer_size=None):
+        """ internal. Body of compress, self.compressing is set by caller """
+        if buffer_size is None:
+            buffer_size = self.COMPRESS_BUFFER_SIZE
+        try:
+            with self.lock:
+                # hash -> index record, files are copied up to key_end
+                self.__flush__()
+                snapshot = dict((rec[0], rec) for rec in self.__index_records__())
+                key_end = self.key_file.tell()
+                key_version = self.key_version
+            magic, head, block = self.KEY_FORMATS[self.KEY_VERSION]
+            key_name = self.filename + '.key.compress'
+            value_name = self.filename + '.value.compress'
+            # hash -> (hash, key_offset, key_size, flags, value_offset, value_size)
+            # of copied record
+            new = dict()
+            with open(key_name, 'wb', buffering=buffer_size) as nk, \
+                    open(value_name, 'wb', buffering=buffer_size) as nv:
+
+                def copy(hash, key, value, flags):
+                    value_offset = nv.tell()
+                    padding = self.__value_padding__(value_offset, len(value), block)
+                    nv.write(bytes(padding))
+                    value_offset += padding
+                    nv.write(value)
+                    new[hash] = (hash, nk.tell(), len(key), flags, value_offset, len(value))
+                    nk.write(magic)
+                    nk.write(head.pack(len(key), flags, value_offset // block, len(value)))
+                    nk.write(key)
+
+                # copy live records in order of key-file
+                with open(self.filename + '.key', 'rb') as fk, \
+                        open(self.filename + '.value', 'rb', buffering=buffer_size) as fv:
+                    for flags, key_size, value_offset, value_size, key, key_offset in key_records(
+                            fk, key_version, buffer_size=buffer_size):
+                        if key_offset >= key_end:
+                            break
+                        hash = md5(key).digest()
+                        rec = snapshot.get(hash)
+                        if rec is None or rec[1] != key_offset:
+                            continue
+                        fv.seek(value_offset)
+                        copy(hash, key, fv.read(value_size), flags)
+                with self.lock:
+                    self.__flush__()
+                    current = dict((rec[0], rec) for rec in self.__index_records__())
+                    # records updated or deleted while copying
+                    dropped = [new.pop(hash) for hash in list(new)
+                               if current.get(hash) != snapshot[hash]]
+                    # records written while copying
+                    for hash, key_offset, key_size, flags, value_offset, value_size in sorted(
+                            (rec for hash, rec in current.items() if hash not in new),
+                            key=lambda rec: rec[1]):
+                        key = os.pread(self.key_fd, key_size, key_offset + self.key_header_size)
+                        copy(hash, key, os.pread(self.value_fd, value_size, value_offset), flags)
+                    for hash, key_offset, key_size, flags, value_offset, value_size in dropped:
+                        nk.seek(key_offset + 12)
+                        nk.write(bytes([flags | FLAG_DELETED]))
+                    nk.flush()
+                    nv.flush()
+                    os.fsync(nk.fileno())
+                    os.fsync(nv.fileno())
+                    nk.close()
+                    nv.close()
+                    # switch files, see __recover_compress__ for crash in between
+                    self.__close_files__()
+                    try:
+                        os.remove(self.filename + '.idx')
+                    except FileNotFoundError:
+                        pass
+                    os.replace(value_name, self.filename + '.value')
+                    os.replace(key_name, self.filename + '.key')
+                    self.__open_files__()
+                    # keys are the same, .kdx must match new .idx
+                    self.__save_keys__()
+                    # journal of old files must not be replayed over new index
+                    self.journal.reset(self.key_file.tell())
+                    IndexFile.write(self.filename + '.idx', (new[hash] for hash in sorted(new)))
+                    self.base = IndexFile(self.filename + '.idx')
+                    self.index = HashCache()
+                    self.live_size = None
+                    self.__build_bloom__()
+                    self.__save_bloom__()
+        finally:
+            self.compressing = False
+
+    def __recover_compress__(self):
+        """ internal
+        Finishes or drops files of compress, interrupted by crash
+        .value is replaced before .key, so single .key.compress is new key-file
+        """
+        key_name = self.filename + '.key.compress'
+        value_name = self.filename + '.value.compress'
+        if os.path.exists(value_name):
+            os.remove(value_name)
+            if os.path.exists(key_name):
+                os.remove(key_name)
+        elif os.path.exists(key_name):
+            os.replace(key_name, self.filename + '.key')
 
     def build_index(self):
         """
-        Builds new index from key-file
+        Builds new index from key-file and saves it
         """
-        # delete current index
-        self.index = HashCache()
-        # read .key-file and build index
-        for flags, key_size, value_offset, value_size, key, key_offset in self.__keys__():
-            #print(flags, key_size, value_offset, value_size, key, key_offset)
-            self.__put_to_index__(key, key_offset, value_offset, value_size)
+        # read .key-file and build new index at once
+        self.base = None
+        self.live_size = None
+        self.index = HashCache.from_items(
+            (key, struct.pack('qqqi', key_offset, value_offset, value_size, flags))
+            for flags, key_size, value_offset, value_size, key, key_offset in self.__keys__())
+        if self.ordered:
+            self.keys_base = None
+            self.keys_delta = dict((key, True) for hash, key, index_info in self.index.ht)
+            self.keys_sorted = None
+        self.__build_bloom__()
+        self.save_index()
+
+    def __load_bloom__(self):
+        """ internal
+        Loads bloom filter saved next to index, rebuilds it if not suitable
+        or saved for other .idx (tags differ)
+        """
+        self.bloom = BloomFilter.load(self.filename + '.bloom')
+        if self.bloom is None or self.base is None or self.bloom.tag != self.base.tag \
+                or self.bloom.fp_rate != self.bloom_fp_rate or self.bloom.is_full():
+            self.__build_bloom__()
+            # saved, so it is not rebuilt on every open till checkpoint
+            if self.base is not None:
+                self.__save_bloom__()
+            return
+        # bloom is saved with .idx, keys of journal are added
+        for hash, key, index_info in self.index.ht:
+            self.bloom.add_hash(hash)
+        if self.bloom.is_full():
+            self.__build_bloom__()
+
+    def __build_bloom__(self, hashes=()):
+        """ internal
+        Builds bloom filter from index and hashes of keys not in index yet,
+        with room for as much keys again
+        """
+        capacity = max((self.__index_count__() + len(hashes)) * 2, self.BLOOM_CAPACITY)
+        self.bloom = BloomFilter(capacity, self.bloom_fp_rate)
+        if self.base is not None:
+            for hash, *rest in self.base:
+                self.bloom.add_hash(hash)
+        for hash, key, index_info in self.index.ht:
+            self.bloom.add_hash(hash)
+        for hash in hashes:
+            self.bloom.add_hash(hash)
 
     def __keys__(self):
-        """ internal. Generator for records
+        """ internal. Generator for records, see key_records
         raises: (flags, key_size, value_offset, value_size, key, key_offset)
         """
+        self.key_file.flush()
         with open(self.filename + '.key', 'rb') as fin:
-            b = fin.read()  # read all file
-        if len(b) > 32:
-            pos = 0
-            while True:
-                pos = b.find(self.KEY_MAGIC_NUMBER, pos)
-                if pos == -1:
-                    break
-                key_size, flags, value_offset, value_size = struct.unpack_from('iiii', b, pos + 8)
-                key = b[pos + 24:pos + 24 + key_size].decode()
-                key_offset = pos + 24
-                if flags == 0:
-                    yield (flags, key_size, value_offset, value_size, key, key_offset)
-                pos += 1
+            for flags, key_size, value_offset, value_size, key, key_offset in key_records(fin, self.key_version):
+                yield (flags, key_size, value_offset, value_size, key.decode(), key_offset)
 
     def __save_value_record__(self, value):
         """ internal
-        Saves value to file
-        return: value_offset and value_size
+        Saves value to file, compressed by codec
+        return: value_offset (in bytes), value_size and flags for key record
         """
-        value = str(value)
+        flags, value = encode(str(value).encode(), self.codec, self.codec_threshold)
         # write value-file
         self.value_file.seek(0, SEEK_END)
-        value_offset = self.value_file.tell() / 256
-        align = self.value_file.tell() - int(value_offset) * 256
-        # if file suddenly was corrupted then fill till 256 bytes
-        for i in range(align):
-            self.value_file.write(b'\x00')
-        value_offset = int(self.value_file.tell() / 256)
-        self.value_file.write(value.encode())
-        align = 256 - len(value) % 256
-        # if len(value) % 256 != 0, then fill end
-        for i in range(align):
-            self.value_file.write(b'\x00')
-        self.value_file.flush()
-        return value_offset, len(value)
+        value_offset = self.value_file.tell()
+        padding = self.__value_padding__(value_offset, len(value), self.key_block)
+        if padding:
+            self.value_file.write(bytes(padding))
+            value_offset += padding
+        self.value_file.write(value)
+        return value_offset, len(value), flags
 
-    def __save_key_record__(self, key, value_offset, value_size):
+    def __value_padding__(self, offset, size, unit):
+        """ internal
+        Returns count of zero bytes to write at offset before value of size
+        unit - size of value_offset unit in key-file, offset must be aligned to it
+        """
+        if unit > 1:
+            # version 1: value_offset is count of blocks
+            return -offset % unit
+        tail = -offset % self.value_block
+        if size <= tail:
+            # small value is packed into the rest of current block
+            return 0
+        return tail
+
+    def __save_key_record__(self, key, value_offset, value_size, flags=0):
         """ internal
         Saves key-record to file
         return: key_offset
         """
-        key = str(key)
+        key = str(key).encode()
         # write key-file
         self.key_file.seek(0, SEEK_END)
         key_offset = self.key_file.tell()
-        self.key_file.write(self.KEY_MAGIC_NUMBER)
-        key_struct = struct.pack('iiii', len(key), 0, value_offset, value_size)
+        self.key_file.write(self.key_magic)
+        key_struct = self.key_head.pack(len(key), flags, value_offset // self.key_block, value_size)
         self.key_file.write(key_struct)
-        self.key_file.write(key.encode())
-        self.key_file.flush()
+        self.key_file.write(key)
         return key_offset
 
     def __get_key_record__(self, key_offset):
         """
         Reads key record from file from key_offset.
-        Returns (key, flags, value_offset, value_size)
+        Returns (key, flags, value_offset, value_size), value_offset in bytes
         If none found, then returns (None, ...)
         """
-        with open(self.filename + '.key', 'rb') as f_key:
-            # get file length
-            f_len = f_key.seek(0, SEEK_END)
-            if f_len < key_offset:
-                raise IndexError
-                # set pos to key_offset
-            f_key.seek(key_offset, SEEK_SET)
-            # read record
-            magic = f_key.read(8)
-            # check record
-            if magic == self.KEY_MAGIC_NUMBER:
-                k_s = f_key.read(4 * 4)
-                key_size, flags, value_offset, value_size = struct.unpack('iiii', k_s)
-                key = f_key.read(key_size)
-                return (key, flags, value_offset, value_size)
-            else:
-                # if not valid, then rebuild index
-                self.build_index()
-                raise IndexError
+        # read header of record
+        header = os.pread(self.key_fd, self.key_header_size, key_offset)
+        if len(header) < self.key_header_size:
+            raise IndexError
+        # check record
+        if header[:8] == self.key_magic:
+            key_size, flags, value_offset, value_size = self.key_head.unpack_from(header, 8)
+            key = os.pread(self.key_fd, key_size, key_offset + self.key_header_size).decode()
+            return (key, flags, value_offset * self.key_block, value_size)
+        else:
+            # if not valid, then rebuild index
+            self.build_index()
+            raise IndexError
 
-    def __put_to_index__(self, key, key_offset, value_offset, value_size):
+    def __put_to_index__(self, key, key_offset, value_offset, value_size, flags=0):
         """ internal
-        Puts to index (key_offset, value_offset, value_size)-struct for 'key'
+        Puts to index (key_offset, value_offset, value_size, flags)-struct for 'key'
+        and appends it to journal. If flags has FLAG_DELETED, key is deleted
         """
-        self.index[key] = struct.pack('iii', key_offset, value_offset, value_size)
+        key = str(key)
+        k = key.encode()
+        hash = md5(k).digest()
+        self.journal.append(hash, key_offset, len(k), flags, value_offset, value_size, k)
+        index_info = None
+        if not flags & FLAG_DELETED:
+            index_info = struct.pack('qqqi', key_offset, value_offset, value_size, flags)
+        self.index.__set__(hash, key, index_info)
+        if self.ordered:
+            self.keys_delta[key] = index_info is not None
+            self.keys_sorted = None
 
     def __get_from_index__(self, key):
         """ internal
-        Returns (key_offset, value_offset, value_size)-struct for 'key' if found
-        if not found returns None, None, None
+        Returns (key_offset, value_offset, value_size, flags)-struct for 'key' if found
+        if not found returns None, None, None, None
         """
-        index_info = self.index[key]
-        if index_info is not None:
-            key_offset, value_offset, value_size = struct.unpack("iii", index_info)
-            return key_offset, value_offset, value_size
+        hash = hash_md5(key)
+        try:
+            hash, k, index_info = self.index.__get__(hash)
+        except KeyError:
+            pass
         else:
-            return None, None, None
+            if index_info is None:
+                # deleted after index was loaded
+                return None, None, None, None
+            return struct.unpack("qqqi", index_info)
+        if self.base is not None:
+            found = self.base.find(hash)
+            if found is not None:
+                key_offset, key_size, flags, value_offset, value_size = found
+                return key_offset, value_offset, value_size, flags
+        return None, None, None, None
+
+    def __index_count__(self):
+        """ internal. Count of keys in index, keys updated after load are counted twice """
+        if self.base is None:
+            return self.index.ht_count
+        return len(self.base) + self.index.ht_count
+
+    def __index_records__(self):
+        """ internal
+        Generator for (hash, key_offset, key_size, flags, value_offset, value_size)
+        of whole index, sorted by hash
+        Merges saved index with changes made after it was loaded
+        """
+        base = iter(self.base if self.base is not None else ())
+        delta = iter(self.index.ht)
+        b = next(base, None)
+        d = next(delta, None)
+        while b is not None or d is not None:
+            if d is None or (b is not None and b[0] < d[0]):
+                yield b
+                b = next(base, None)
+                continue
+            if b is not None and b[0] == d[0]:
+                # changed after load
+                b = next(base, None)
+            hash, key, index_info = d
+            if index_info is not None:
+                key_offset, value_offset, value_size, flags = struct.unpack("qqqi", index_info)
+                yield (hash, key_offset, len(key.encode()), flags, value_offset, value_size)
+            d = next(delta, None)
 
     def load_index(self):
         """
-        Load previously saved index
+        Load previously saved index and replay journal over it
+        Versions 3 and 2 are only mapped, version 1 is read and all its keys
+        are read from key-file
         """
         with open(self.filename + ".idx", 'rb') as idx:
             magic = idx.read(4)
             if magic != self.IDX_MAGIC_NUMBER:
                 raise FileNotFoundError
             ver_id, rec_count, reserved = struct.unpack("iii", idx.read(4 * 3))
-            if ver_id != 1:
+            self.live_size = None
+            if ver_id in IndexFile.RECORDS:
+                records = None
+            elif ver_id == 1:
+                records = idx.read(rec_count * 4 * 4)
+            else:
                 raise FileNotFoundError
-            for i in range(rec_count):
-                k_off, k_size, v_off, v_size = struct.unpack("iiii", idx.read(4 * 4))
-                key, *rest = self.__get_key_record__(k_off)
-                self.__put_to_index__(key, k_off, v_off, v_size)
+        if records is None:
+            self.base = IndexFile(self.filename + ".idx")
+            self.index = HashCache()
+        else:
+            self.base = None
+
+            def items():
+                for k_off, k_size, v_off, v_size in struct.iter_unpack("iiii", records):
+                    key, flags, value_offset, value_size = self.__get_key_record__(k_off)
+                    yield key, struct.pack('qqqi', k_off, v_off * 256, v_size, flags)
+            self.index = HashCache.from_items(items())
+        if self.ordered:
+            self.__load_keys__()
+        self.__replay_journal__()
+
+    def __replay_journal__(self):
+        """ internal
+        Applies journal to loaded index, then records of key-file appended
+        after last journaled one (their entries did not reach disk)
+        raises ValueError if journal points beyond files
+        """
+        self.__flush__()
+        self.journal.close()
+        try:
+            key_end, entries = self.journal.read()
+        except FileNotFoundError:
+            # files of older version, index was saved on close
+            self.journal.reset(self.key_file.tell())
+            return
+        key_len = os.fstat(self.key_fd).st_size
+        value_len = os.fstat(self.value_fd).st_size
+        for hash, key_offset, key_size, flags, value_offset, value_size, key in entries:
+            end = key_offset + self.key_header_size + key_size
+            if end > key_len or value_offset + value_size > value_len:
+                raise ValueError('journal does not match files')
+            index_info = None
+            if not flags & FLAG_DELETED:
+                index_info = struct.pack('qqqi', key_offset, value_offset, value_size, flags)
+            key = key.decode()
+            self.index.__set__(hash, key, index_info)
+            if self.ordered:
+                self.keys_delta[key] = index_info is not None
+                self.keys_sorted = None
+            key_end = max(key_end, end)
+        self.journal.open()
+        with open(self.filename + '.key', 'rb') as fin:
+            fin.seek(key_end)
+            for flags, key_size, value_offset, value_size, key, key_offset in key_records(fin, self.key_version):
+                if value_offset + value_size > value_len:
+                    # value was lost
+                    break
+                self.__put_to_index__(key.decode(), key_offset, value_offset, value_size, flags)
 
     def save_index(self):
         """
-        Save index to file
-        You can now just load index, not rebuild it on start
+        Save index to file and clear journal (checkpoint)
+        You can now just load index, not replay journal on start
+        Does nothing if index has not changed since it was saved
         """
-        with open(self.filename + ".idx", 'wb') as idx:
-            # write header
-            idx.write(self.IDX_MAGIC_NUMBER)
-            idx.write(b'\x01\x00\x00\x00')
-            idx.write(struct.pack('i', self.index.ht_count))
-            idx.write(b'\x00\x00\x00\x00')
-            # write body
-            for i in range(self.index.ht_count):
-                hash, key, index_info = self.index.ht[i]
-                key_offset, value_offset, value_size = struct.unpack('iii', index_info)
-                rec = struct.pack('iiii', key_offset, len(key), value_offset, value_size)
-                idx.write(rec)
+        with self.lock:
+            self.__flush__()
+            if self.base is not None and not self.index.ht_count and not self.keys_delta:
+                return
+            self.__checkpoint__(self.__index_records__())
+
+    def __checkpoint__(self, records):
+        """ internal
+        Saves records as index, they must be all records of index
+        """
+        IndexFile.write(self.filename + ".idx", records)
+        # saved index has all changes now
+        self.base = IndexFile(self.filename + ".idx")
+        self.index = HashCache()
+        self.__save_keys__()
+        self.journal.reset(self.key_file.tell())
+        if self.bloom.is_full():
+            self.__build_bloom__()
+        self.__save_bloom__()
+
+    def __save_bloom__(self):
+        """ internal
+        Saves bloom filter with tag of .idx, so it is not used with other one
+        """
+        self.bloom.tag = self.base.tag
+        self.bloom.save(self.filename + '.bloom')
 
 
 
 class FileStorageTest(TestCase):
     def setUp(self):
-        try:
-            os.unlink('test.icdb.key')
-            os.unlink('test.icdb.value')
-            os.unlink('test.icdb.idx')
-        except FileNotFoundError:
-            pass
+        for ext in ('.key', '.value', '.idx', '.bloom', '.journal', '.kdx'):
+            try:
+                os.unlink('test.icdb' + ext)
+            except FileNotFoundError:
+                pass
         self.fs = FileStorage()
 
     def test_set_get(self):
@@ -322,6 +1276,7 @@ class FileStorageTest(TestCase):
         self.fs.save_index()
         self.fs['111'] = '111'
         self.fs.load_index()
+        self.assertEqual('123', self.fs['123'])
         try:
             print(self.fs['111'])
         except IndexError:
@@ -329,3 +1284,465 @@ class FileStorageTest(TestCase):
         else:
             return False
 
+    def test_build_index(self):
+        self.fs['ключ'] = 'значение'
+        self.fs['1'] = 'one'
+        self.fs.build_index()
+        self.assertEqual('значение', self.fs['ключ'])
+        self.assertEqual('one', self.fs['1'])
+
+    def test_bloom(self):
+        self.fs['1'] = 'one'
+        self.assertIn('1', self.fs.bloom)
+        self.assertIsNone(self.fs['2'])
+        for i in range(self.fs.BLOOM_CAPACITY * 2):
+            self.fs[i] = i
+        self.assertEqual('1500', self.fs[1500])
+        self.assertGreater(self.fs.bloom.capacity, self.fs.BLOOM_CAPACITY)
+        misses = sum(1 for i in range(1000) if 'miss %i' % i in self.fs.bloom)
+        self.assertLess(misses, 50)
+
+    def test_index_v2(self):
+        for i in range(100):
+            self.fs[i] = i
+        self.fs.save_index()
+        self.assertEqual(0, self.fs.index.ht_count)
+        self.assertEqual(100, len(self.fs.base))
+        self.fs[5] = 'five'
+        self.fs['new'] = 'new'
+        fs2 = FileStorage()
+        self.assertEqual('42', fs2[42])
+        self.fs.save_index()
+        fs2 = FileStorage()
+        self.assertEqual('five', fs2[5])
+        self.assertEqual('new', fs2['new'])
+        self.assertEqual(101, len(fs2.base))
+
+    def test_stale_bloom(self):
+        # key overwritten many times, count of bloom grows over count of .idx
+        for i in range(300):
+            self.fs[1] = i
+        for i in range(100):
+            self.fs[i] = i
+        self.fs.save_index()
+        with open('test.icdb.bloom', 'rb') as f:
+            old = f.read()
+        self.fs['new'] = 'new'
+        self.fs.save_index()
+        del self.fs
+        with open('test.icdb.bloom', 'wb') as f:
+            f.write(old)
+        fs = FileStorage()
+        self.assertEqual('new', fs['new'])
+        self.assertEqual(fs.base.tag, fs.bloom.tag)
+
+    def __write_v1__(self, pairs):
+        """ writes files of version 1 for pairs """
+        del self.fs
+        with open('test.icdb.key', 'wb') as k, open('test.icdb.value', 'wb') as v:
+            for i, (key, value) in enumerate(pairs):
+                k.write(FileStorage.KEY_MAGIC_NUMBER)
+                k.write(struct.pack('iiii', len(key), 0, i, len(value)))
+                k.write(key)
+                v.write(value.ljust(256, b'\x00'))
+        for ext in ('.idx', '.bloom'):
+            os.unlink('test.icdb' + ext)
+
+    def test_version_1(self):
+        self.__write_v1__([(b'1', b'one'), (b'2', b'two'), (b'1', b'uno')])
+        fs = FileStorage()
+        self.assertEqual(1, fs.key_version)
+        self.assertEqual('uno', fs['1'])
+        fs['3'] = 'three'
+        self.assertEqual('three', fs['3'])
+        self.assertEqual(256 * 3 + 5, os.path.getsize('test.icdb.value'))
+        self.assertEqual('two', fs['2'])
+
+    def test_index_file_v2(self):
+        from zlib import crc32
+        self.__write_v1__([(b'1', b'one'), (b'2', b'two'), (b'1', b'uno')])
+        # records of key-file are 25 bytes, values are in 256-byte blocks
+        records = sorted([(md5(b'1').digest(), 50, 1, 2, 3), (md5(b'2').digest(), 25, 1, 1, 3)])
+        header = IndexFile.HEADER.pack(IndexFile.MAGIC_NUMBER, 2, 2, IndexFile.RECORDS[2].size, 0)
+        with open('test.icdb.idx', 'wb') as fout:
+            fout.write(header)
+            fout.write(IndexFile.CHECKSUM.pack(crc32(header)))
+            for rec in records:
+                fout.write(IndexFile.RECORDS[2].pack(*rec))
+        inode = os.stat('test.icdb.idx').st_ino
+        fs = FileStorage()
+        # index is mapped, not rebuilt
+        self.assertEqual(2, fs.base.version)
+        self.assertEqual(inode, os.stat('test.icdb.idx').st_ino)
+        self.assertEqual('uno', fs['1'])
+        self.assertEqual('two', fs['2'])
+        fs['3'] = 'three'
+        fs.save_index()
+        self.assertEqual(3, fs.base.version)
+        self.assertEqual('two', fs['2'])
+
+    def test_migrate(self):
+        from icdb.storage.migrate import migrate
+        self.__write_v1__([(b'1', b'one'), (b'2', b'two'), (b'1', b'uno')])
+        self.assertTrue(migrate('test.icdb', buffer_size=16))
+        self.assertFalse(migrate('test.icdb'))
+        fs = FileStorage()
+        self.assertEqual(2, fs.key_version)
+        self.assertEqual(2, len(fs.base))
+        self.assertEqual('uno', fs['1'])
+        self.assertEqual('two', fs['2'])
+        fs.build_index()
+        self.assertEqual('uno', fs['1'])
+        self.assertEqual(2, len(fs.base))
+
+    def test_value_block(self):
+        for i in range(10):
+            self.fs[i] = 'v' * 20
+        self.fs['big'] = 'b' * 300
+        self.fs['small'] = 's' * 20
+        # ten small values share first block, big one starts at boundary
+        self.assertEqual(256 + 300 + 20, os.path.getsize('test.icdb.value'))
+        self.assertEqual('v' * 20, self.fs[9])
+        self.assertEqual('b' * 300, self.fs['big'])
+        self.assertEqual('s' * 20, self.fs['small'])
+        del self.fs
+        fs = FileStorage(value_block=1)
+        fs['x'] = 'xyz'
+        self.assertEqual(256 + 300 + 20 + 3, os.path.getsize('test.icdb.value'))
+        fs.build_index()
+        self.assertEqual('xyz', fs['x'])
+        self.assertEqual('b' * 300, fs['big'])
+        self.assertRaises(ValueError, FileStorage, value_block=0)
+        self.assertRaises(ValueError, FileStorage, value_block=-256)
+
+    def test_delete(self):
+        self.fs['1'] = 'one'
+        self.fs['2'] = 'two'
+        self.fs.delete('1')
+        self.fs.delete('3')
+        self.assertIsNone(self.fs['1'])
+        # deleted key stays in bloom filter, but key-file is not scanned for it
+        self.fs.save_index()
+        self.assertIn('1', self.fs.bloom)
+
+        def keys():
+            raise AssertionError('key-file is scanned')
+        self.fs.__keys__ = keys
+        self.assertIsNone(self.fs['1'])
+        self.assertEqual([None, 'two'], self.fs.get_many(['1', '2']))
+        del self.fs.__keys__
+        self.fs.build_index()
+        self.assertIsNone(self.fs['1'])
+        self.assertEqual('two', self.fs['2'])
+
+    def test_compress(self):
+        for i in range(100):
+            self.fs[i] = 'value %i' % i
+        for i in range(50):
+            self.fs[i] = 'new %i' % i
+        for i in range(90, 100):
+            self.fs.delete(i)
+        self.assertGreater(self.fs.space_amplification(), 1.5)
+        size = os.path.getsize('test.icdb.value')
+        self.assertTrue(self.fs.compress(buffer_size=100))
+        self.assertLess(self.fs.space_amplification(), 1.01)
+        self.assertLess(os.path.getsize('test.icdb.value'), size * 2 / 3)
+        self.assertEqual('new 10', self.fs[10])
+        self.assertEqual('value 60', self.fs[60])
+        self.assertIsNone(self.fs[95])
+        self.fs[60] = 'after'
+        del self.fs
+        fs = FileStorage()
+        self.assertEqual(90, len(fs.base))
+        self.assertEqual('after', fs[60])
+        self.assertEqual('new 10', fs[10])
+        fs.build_index()
+        self.assertEqual(90, len(fs.base))
+
+    def test_compress_saves_bloom(self):
+        for i in range(10):
+            self.fs['a'] = 'value %i' % i
+        self.fs.save_index()
+        self.fs['k'] = 'v'
+        self.assertTrue(self.fs.compress())
+        del self.fs
+        fs = FileStorage()
+        self.assertEqual('v', fs['k'])
+        self.assertEqual('value 9', fs['a'])
+
+    def test_compress_concurrent(self):
+        for i in range(1000):
+            self.fs[i] = i
+        expected = dict((str(i), str(i)) for i in range(1000))
+        thread = threading.Thread(target=self.fs.compress, args=(64,))
+        thread.start()
+        for i in range(0, 1000, 3):
+            self.fs[i] = 'new %i' % i
+            expected[str(i)] = 'new %i' % i
+            self.fs.delete(i + 1)
+            expected.pop(str(i + 1), None)
+            self.assertEqual(expected.get(str(i + 2)), self.fs[i + 2])
+        thread.join()
+        for key, value in expected.items():
+            self.assertEqual(value, self.fs[key])
+        self.fs.build_index()
+        self.assertEqual(len(expected), len(self.fs.base))
+
+    def test_auto_compress(self):
+        self.fs = FileStorage(compress_ratio=3)
+        self.fs.COMPRESS_MIN_SIZE = 0
+        for i in range(20):
+            self.fs['1'] = i
+            if self.fs.compress_thread is not None:
+                self.fs.compress_thread.join()
+        self.assertLess(self.fs.space_amplification(), 3)
+        self.assertEqual('19', self.fs['1'])
+
+    def test_recover_compress(self):
+        self.fs['1'] = 'one'
+        del self.fs
+        with open('test.icdb.key.compress', 'wb'), open('test.icdb.value.compress', 'wb'):
+            pass
+        fs = FileStorage()
+        self.assertFalse(os.path.exists('test.icdb.key.compress'))
+        self.assertFalse(os.path.exists('test.icdb.value.compress'))
+        self.assertEqual('one', fs['1'])
+
+    def test_codec(self):
+        self.assertRaises(ValueError, FileStorage, codec='gzip')
+        text = 'some repetitive text ' * 100
+        fs = FileStorage(codec='lzma', value_block=1)
+        fs['long'] = text
+        fs['short'] = 'tiny'
+        fs['other'] = text
+        fs['other'] = 'x'
+        self.assertLess(os.path.getsize('test.icdb.value'), len(text))
+        self.assertEqual(text, fs['long'])
+        self.assertEqual('tiny', fs['short'])
+        self.assertEqual('x', fs['other'])
+        fs.compress()
+        self.assertEqual(text, fs['long'])
+        del fs
+        # reader without codec decompresses by flags
+        fs = FileStorage()
+        self.assertEqual(text, fs['long'])
+        fs.build_index()
+        self.assertEqual(text, fs['long'])
+        self.assertEqual('x', fs['other'])
+
+    def test_durability(self):
+        self.assertRaises(ValueError, FileStorage, durability='always')
+        del self.fs
+        fs = FileStorage(durability='none')
+        fs['1'] = 'one'
+        self.assertEqual(0, os.path.getsize('test.icdb.value'))
+        self.assertEqual('one', fs['1'])
+        fs.set_many({'2': 'two', '3': 'three'})
+        del fs
+        fs = FileStorage(durability='fsync-per-write')
+        self.assertEqual('three', fs['3'])
+        threads = [threading.Thread(target=fs.set_many, args=([(i * 100 + j, j) for j in range(100)],))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fs.write_seq, fs.synced_seq)
+        self.assertEqual('5', fs[705])
+        # commit thread does not keep storage alive
+        ref = weakref.ref(fs)
+        thread = fs.commit_thread
+        del fs
+        thread.join(1)
+        self.assertIsNone(ref())
+        self.assertFalse(thread.is_alive())
+        fs = FileStorage(durability='fsync-interval', fsync_interval=0.01)
+        fs['4'] = 'four'
+        fs.commit_thread.join(0.2)
+        self.assertEqual(fs.write_seq, fs.synced_seq)
+        self.assertEqual('four', fs['4'])
+
+    def test_journal(self):
+        for i in range(100):
+            self.fs[i] = i
+        self.fs.save_index()
+        self.fs[5] = 'five'
+        self.fs.delete(6)
+        self.fs['new'] = 'new'
+        # records, which have not reached journal
+        value_offset, value_size, flags = self.fs.__save_value_record__('tail')
+        self.fs.__save_key_record__('tail', value_offset, value_size, flags)
+        self.fs.sync()
+        # files as they are left by crash, with torn journal entry
+        for ext in ('.key', '.value', '.idx', '.bloom', '.journal'):
+            with open('test.icdb' + ext, 'rb') as fin, open('test.icdb.crash' + ext, 'wb') as fout:
+                fout.write(fin.read())
+        with open('test.icdb.crash.journal', 'ab') as fout:
+            fout.write(bytes(30))
+        fs = FileStorage('test.icdb.crash')
+        self.assertEqual(100, len(fs.base))
+        self.assertEqual(4, fs.index.ht_count)
+        self.assertEqual('five', fs[5])
+        self.assertIsNone(fs[6])
+        self.assertEqual('new', fs['new'])
+        self.assertEqual('tail', fs['tail'])
+        self.assertEqual('42', fs[42])
+        # torn entry is cut off, so entries appended after it are read
+        fs.delete('new')
+        del fs
+        fs = FileStorage('test.icdb.crash')
+        self.assertIsNone(fs['new'])
+        # close does not save index, journal is replayed again
+        del fs
+        fs = FileStorage('test.icdb.crash')
+        self.assertEqual(100, len(fs.base))
+        self.assertEqual(4, fs.index.ht_count)
+        # journal over checkpoint_size is saved on open
+        del fs
+        fs = FileStorage('test.icdb.crash', checkpoint_size=16)
+        self.assertEqual(0, fs.index.ht_count)
+        self.assertEqual(100, len(fs.base))
+        del fs
+        fs = FileStorage('test.icdb.crash', checkpoint_size=1024)
+        for i in range(100):
+            fs[i] = 'new %i' % i
+        self.assertLess(fs.journal.size(), 1024)
+        self.assertGreater(len(fs.base), 0)
+        self.assertEqual('new 42', fs[42])
+        # nothing changed, so neither save_index nor close rewrite .idx
+        fs.save_index()
+        inode = os.stat('test.icdb.crash.idx').st_ino
+        self.assertEqual('new 7', fs[7])
+        fs.save_index()
+        del fs
+        self.assertEqual(inode, os.stat('test.icdb.crash.idx').st_ino)
+        for ext in ('.key', '.value', '.idx', '.bloom', '.journal'):
+            os.unlink('test.icdb.crash' + ext)
+
+    def test_get_many(self):
+        text = 'some repetitive text ' * 100
+        fs = FileStorage(codec='zlib')
+        for i in range(100):
+            fs[i] = i
+        fs['long'] = text
+        fs[50] = 'fifty'
+        fs.delete(70)
+        fs.save_index()
+        fs['after'] = 'after'
+        keys = [99, 'long', 50, 'miss', 3, 70, 'after', 3]
+        expected = ['99', text, 'fifty', None, '3', None, 'after', '3']
+        self.assertEqual(expected, fs.get_many(keys))
+        fs.READ_GAP = 0
+        fs.READ_SIZE = 1
+        self.assertEqual(expected, fs.get_many(iter(keys)))
+        self.assertEqual([], fs.get_many([]))
+
+    def test_ordered(self):
+        self.assertRaises(ValueError, self.fs.scan)
+        del self.fs
+        fs = FileStorage(ordered=True)
+        fs.SCAN_BATCH = 7
+        for i in range(200):
+            fs['2013-%03i' % i] = i
+        fs['2012-999'] = 'old'
+        fs['2014-000'] = 'new'
+        self.assertEqual([('2013-010', '10'), ('2013-011', '11')], list(fs.scan('2013-010', '2013-012')))
+        fs.save_index()
+        fs.delete('2013-011')
+        fs['2013-0105'] = 'between'
+        fs['2013-012'] = 'twelve'
+        expected = [('2013-010', '10'), ('2013-0105', 'between'), ('2013-012', 'twelve')]
+        self.assertEqual(expected, list(fs.scan('2013-010', '2013-013')))
+        self.assertEqual(202, len(list(fs.scan())))
+        self.assertEqual(['2012-999'], [key for key, value in fs.prefix('2012')])
+        self.assertEqual(expected[:2], list(fs.prefix('2013-010')))
+        self.assertEqual([], list(fs.prefix('2015')))
+        del fs
+        fs = FileStorage(ordered=True)
+        self.assertEqual(202, len(fs.keys_base))
+        self.assertEqual(expected, list(fs.scan('2013-010', '2013-013')))
+        # built from key-file, if absent
+        del fs
+        os.unlink('test.icdb.kdx')
+        fs = FileStorage(ordered=True)
+        self.assertEqual(expected, list(fs.scan('2013-010', '2013-013')))
+        self.assertEqual(('2014-000', 'new'), list(fs.scan('2013-199'))[-1])
+        # opened without ordered index, it is dropped
+        del fs
+        fs = FileStorage()
+        fs.save_index()
+        self.assertFalse(os.path.exists('test.icdb.kdx'))
+        del fs
+        # changes after checkpoint are replayed from journal after crash
+        fs = FileStorage(ordered=True)
+        fs.save_index()
+        fs['k50'] = 'fifty'
+        fs.delete('2013-010')
+        fs.sync()
+        for ext in ('.key', '.value', '.idx', '.bloom', '.journal', '.kdx'):
+            with open('test.icdb' + ext, 'rb') as fin, open('test.icdb.crash' + ext, 'wb') as fout:
+                fout.write(fin.read())
+        fs = FileStorage('test.icdb.crash', ordered=True)
+        self.assertEqual('fifty', fs['k50'])
+        self.assertEqual([('k50', 'fifty')], list(fs.prefix('k')))
+        self.assertEqual([('2013-0105', 'between')], list(fs.scan('2013-010', '2013-011')))
+        # and saved with next checkpoint
+        fs.save_index()
+        del fs
+        fs = FileStorage('test.icdb.crash', ordered=True)
+        self.assertEqual([('k50', 'fifty')], list(fs.prefix('k')))
+        self.assertEqual(202, len(list(fs.scan())))
+        del fs
+        for ext in ('.key', '.value', '.idx', '.bloom', '.journal', '.kdx'):
+            os.unlink('test.icdb.crash' + ext)
+
+    def test_bulk_load(self):
+        self.fs['0'] = 'old'
+        self.fs['x'] = 'x'
+        count = self.fs.bulk_load(((i % 100, i) for i in range(300)), buffer_size=100)
+        self.assertEqual(300, count)
+        self.assertEqual('200', self.fs[0])
+        self.assertEqual('299', self.fs[99])
+        self.assertEqual('x', self.fs['x'])
+        self.assertEqual(101, len(self.fs.base))
+        self.assertEqual(0, self.fs.index.ht_count)
+        self.fs.build_index()
+        self.assertEqual(101, len(self.fs.base))
+        self.assertEqual('250', self.fs[50])
+        del self.fs
+        with open('test.icdb.csv', 'w') as fout:
+            fout.write('a,1\r\n"b,c",2\r\na,3\r\n')
+        with open('test.icdb.jsonl', 'w') as fout:
+            fout.write('["j", "v"]\n{"key": "k", "value": {"n": [1, 2]}}\n\n')
+        fs = FileStorage(ordered=True, codec='zlib')
+        self.assertEqual(3, fs.bulk_load('test.icdb.csv'))
+        self.assertEqual(2, fs.bulk_load('test.icdb.jsonl'))
+        self.assertRaises(ValueError, fs.bulk_load, 'test.icdb.csv', format='xml')
+        self.assertEqual('3', fs['a'])
+        self.assertEqual('2', fs['b,c'])
+        self.assertEqual('{"n": [1, 2]}', fs['k'])
+        self.assertEqual(['a', 'b,c', 'j', 'k', 'x'], [key for key, value in fs.scan('a')])
+        self.assertEqual(105, len(list(fs.prefix(''))))
+        del fs
+        fs = FileStorage(ordered=True)
+        self.assertEqual([('j', 'v'), ('k', '{"n": [1, 2]}')], list(fs.scan('j', 'l')))
+        # bad line, nothing of file is loaded
+        key_size = os.path.getsize('test.icdb.key')
+        value_size = os.path.getsize('test.icdb.value')
+        with open('test.icdb.csv', 'w') as fout:
+            fout.write('a,new\r\n' + 'b,%s\r\n' % ('x' * 100) * 100 + 'c\r\n')
+        self.assertRaises(IndexError, fs.bulk_load, 'test.icdb.csv', buffer_size=100)
+        self.assertEqual(key_size, os.path.getsize('test.icdb.key'))
+        self.assertEqual(value_size, os.path.getsize('test.icdb.value'))
+        self.assertEqual('3', fs['a'])
+        self.assertEqual(['a', 'b,c', 'j', 'k', 'x'], [key for key, value in fs.scan('a')])
+        fs['c'] = 'c'
+        del fs
+        fs = FileStorage(ordered=True)
+        self.assertEqual('c', fs['c'])
+        self.assertEqual('3', fs['a'])
+        fs.build_index()
+        self.assertEqual('c', fs['c'])
+        self.assertEqual('2', fs['b,c'])
+        os.unlink('test.icdb.csv')
+        os.unlink('test.icdb.jsonl')
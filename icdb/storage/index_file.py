@@ -0,0 +1,158 @@
+# -------------------------------#
+# Written by icoz, 2013          #
+# email: icoz.vt at gmail.com    #
+# License: GPL v3                #
+# -------------------------------#
+
+"""
+IndexFile is .idx file of FileStorage, versions 2 and 3
+It is memory-mapped and searched in place, nothing is loaded on open.
+Version 3 is written, version 2 is still read.
+
+Header, 32 bytes:
+  magic, 4 byte = b'\\x6a\\xe0\\x0a\\x72'
+  version id, 4 byte = 0x00000003
+  records count, 8 bytes
+  record size, 4 bytes
+  tag, 4 bytes = random, new for each written file (0 in version 2)
+  checksum, 4 bytes = crc32 of previous 24 bytes
+  reserved, 4 bytes
+
+  records, (records count)*(record size), sorted by hash
+Record, version 3, 48 bytes:
+  hash, 16 bytes, md5(key)
+  key_offset, 8 bytes
+  key_size, 4 bytes = count of bytes
+  flags, 4 bytes = flags of key record
+  value_offset, 8 bytes = count of bytes to skip
+  value_size, 8 bytes = count of bytes
+Record, version 2, 32 bytes:
+  hash, 16 bytes, md5(key)
+  key_offset, 4 bytes
+  key_size, 4 bytes = count of bytes
+  value_offset, 4 bytes = count of blocks(256-bytes) to skip
+  value_size, 4 bytes = count of bytes
+
+All numbers are little-endian.
+"""
+
+import mmap
+import os
+import struct
+from zlib import crc32
+
+
+class IndexFile(object):
+    """
+    Read-only sorted index, binary search over mmap-ed file
+    """
+    MAGIC_NUMBER = b'\x6a\xe0\x0a\x72'
+    # version to write
+    VERSION = 3
+    HEADER = struct.Struct('<4siqii')
+    CHECKSUM = struct.Struct('<I4x')
+    HEADER_SIZE = 32
+    # record struct for each readable version
+    RECORDS = {
+        2: struct.Struct('<16siiii'),
+        3: struct.Struct('<16sQIIQQ'),
+    }
+    RECORD = RECORDS[VERSION]
+
+    def __init__(self, filename):
+        """
+        Maps index file
+        raises ValueError if file is not valid index of readable version
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = f.read(self.HEADER_SIZE)
+            if len(header) < self.HEADER_SIZE:
+                raise ValueError('index file is too short')
+            magic, version, count, record_size, tag = self.HEADER.unpack_from(header)
+            checksum, = self.CHECKSUM.unpack_from(header, self.HEADER.size)
+            if magic != self.MAGIC_NUMBER or version not in self.RECORDS:
+                raise ValueError('not an index file of version %s' % list(self.RECORDS))
+            self.version = version
+            self.record = self.RECORDS[version]
+            if checksum != crc32(header[:self.HEADER.size]) or record_size != self.record.size:
+                raise ValueError('index file header is broken')
+            f_len = f.seek(0, os.SEEK_END)
+            if f_len != self.HEADER_SIZE + count * record_size:
+                raise ValueError('index file is truncated')
+            self.count = count
+            # files saved next to index (.bloom) keep tag to match it
+            self.tag = tag
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __normalize__(self, rec):
+        """ internal. Converts version 2 record to version 3 one """
+        hash, key_offset, key_size, value_offset, value_size = rec
+        return (hash, key_offset, key_size, 0, value_offset * 256, value_size)
+
+    def find(self, hash):
+        """
+        Binary search of hash
+        returns (key_offset, key_size, flags, value_offset, value_size) or None
+        value_offset is in bytes for all versions
+        """
+        m = self.map
+        rs = self.record.size
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.HEADER_SIZE + mid * rs
+            h = m[pos:pos + 16]
+            if h < hash:
+                lo = mid + 1
+            elif h > hash:
+                hi = mid
+            else:
+                rec = self.record.unpack_from(m, pos)
+                if self.version == 2:
+                    rec = self.__normalize__(rec)
+                return rec[1:]
+        return None
+
+    def __iter__(self):
+        """
+        yields (hash, key_offset, key_size, flags, value_offset, value_size)
+        sorted by hash
+        """
+        records = self.record.iter_unpack(memoryview(self.map)[self.HEADER_SIZE:])
+        if self.version == 2:
+            return (self.__normalize__(rec) for rec in records)
+        return records
+
+    @classmethod
+    def write(cls, filename, records):
+        """
+        Writes index file from iterable of
+        (hash, key_offset, key_size, flags, value_offset, value_size),
+        sorted by hash
+        File is written to filename.tmp and then replaces filename
+        returns tag of written file
+        """
+        tmp = filename + '.tmp'
+        count = 0
+        with open(tmp, 'wb') as f:
+            f.write(bytes(cls.HEADER_SIZE))
+            buf = bytearray()
+            for rec in records:
+                buf += cls.RECORD.pack(*rec)
+                count += 1
+                if len(buf) >= 1024 * 1024:
+                    f.write(buf)
+                    del buf[:]
+            f.write(buf)
+            tag = struct.unpack('<i', os.urandom(4))[0] or 1
+            header = cls.HEADER.pack(cls.MAGIC_NUMBER, cls.VERSION, count, cls.RECORD.size, tag)
+            f.seek(0)
+            f.write(header)
+            f.write(cls.CHECKSUM.pack(crc32(header)))
+        os.replace(tmp, filename)
+        return tag
@@ -0,0 +1,126 @@
+# -------------------------------#
+# Written by icoz, 2013          #
+# email: icoz.vt at gmail.com    #
+# License: GPL v3                #
+# -------------------------------#
+
+"""
+IndexJournal is .journal file of FileStorage
+Changes of index are appended to it, while .idx keeps checkpoint.
+Index is .idx plus journal replayed over it; on checkpoint new .idx is
+written and journal is cleared.
+
+Header, 16 bytes:
+  magic, 4 byte = b'\\x6a\\xe0\\x0a\\x6a'
+  version id, 4 byte = 0x00000001
+  key_end, 8 bytes = size of .key-file at checkpoint
+
+  entries, one by one
+Entry:
+  record, 48 bytes = record of .idx version 3, flags has bit 0 set for
+    deleted key
+  key, <key_size> bytes
+  checksum, 4 bytes = crc32 of record and key
+
+All numbers are little-endian.
+Entry, which is not written till end (crash), ends journal, it is cut off
+when journal is opened for appends after read.
+"""
+
+import os
+import struct
+from zlib import crc32
+from icdb.storage.index_file import IndexFile
+
+
+class IndexJournal(object):
+    """
+    Append-only log of index changes
+    """
+    MAGIC_NUMBER = b'\x6a\xe0\x0a\x6a'
+    VERSION = 1
+    HEADER = struct.Struct('<4siQ')
+    RECORD = IndexFile.RECORD
+    CHECKSUM = struct.Struct('<I')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fout = None
+        # end of last whole entry, found by read
+        self.end = None
+
+    def read(self):
+        """
+        Reads journal
+        returns (key_end, list of entries), where entry is
+        (hash, key_offset, key_size, flags, value_offset, value_size, key)
+        raises FileNotFoundError if journal is absent and ValueError if it
+        is not a journal
+        """
+        if self.fout is not None:
+            self.fout.flush()
+        with open(self.filename, 'rb') as fin:
+            b = fin.read()
+        if len(b) < self.HEADER.size:
+            raise ValueError('journal is too short')
+        magic, version, key_end = self.HEADER.unpack_from(b)
+        if magic != self.MAGIC_NUMBER or version != self.VERSION:
+            raise ValueError('not a journal of version %i' % self.VERSION)
+        entries = []
+        pos = self.HEADER.size
+        rs = self.RECORD.size
+        while pos + rs <= len(b):
+            rec = self.RECORD.unpack_from(b, pos)
+            key_size = rec[2]
+            end = pos + rs + key_size
+            if end + self.CHECKSUM.size > len(b):
+                break
+            checksum, = self.CHECKSUM.unpack_from(b, end)
+            if checksum != crc32(b[pos:end]):
+                break
+            entries.append(rec + (b[pos + rs:end],))
+            pos = end + self.CHECKSUM.size
+        self.end = pos
+        return key_end, entries
+
+    def reset(self, key_end):
+        """ Clears journal, key_end is size of .key-file at checkpoint """
+        self.close()
+        with open(self.filename + '.tmp', 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC_NUMBER, self.VERSION, key_end))
+        os.replace(self.filename + '.tmp', self.filename)
+        self.end = None
+        self.open()
+
+    def open(self):
+        """
+        Opens journal for appends
+        Torn entry found by read is cut off, else entries appended after it
+        would never be read
+        """
+        if self.fout is None:
+            self.fout = open(self.filename, 'ab')
+            if self.end is not None and self.fout.tell() > self.end:
+                self.fout.truncate(self.end)
+
+    def append(self, hash, key_offset, key_size, flags, value_offset, value_size, key):
+        """ Appends entry, key is bytes """
+        b = self.RECORD.pack(hash, key_offset, key_size, flags, value_offset, value_size) + key
+        self.fout.write(b)
+        self.fout.write(self.CHECKSUM.pack(crc32(b)))
+
+    def size(self):
+        """ size of journal in bytes """
+        return self.fout.tell()
+
+    def flush(self):
+        if self.fout is not None:
+            self.fout.flush()
+
+    def fileno(self):
+        return self.fout.fileno()
+
+    def close(self):
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
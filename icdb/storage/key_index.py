@@ -0,0 +1,146 @@
+# -------------------------------#
+# Written by icoz, 2013          #
+# email: icoz.vt at gmail.com    #
+# License: GPL v3                #
+# -------------------------------#
+
+"""
+KeyIndex is .kdx file of FileStorage: keys sorted by their bytes
+It is memory-mapped, nothing is loaded on open. Every FENCE-th key is a
+fence, offsets of fences are kept in table at the end of file, so
+search is binary search over fences and scan of one block.
+
+Header, 40 bytes:
+  magic, 4 byte = b'\\x6a\\xe0\\x0a\\x6b'
+  version id, 4 byte = 0x00000001
+  keys count, 8 bytes
+  fences count, 8 bytes
+  fences offset, 8 bytes = offset of table of fences
+  checksum, 4 bytes = crc32 of previous 32 bytes
+  reserved, 4 bytes
+
+  records, (keys count), sorted by key
+Record:
+  key_size, 4 bytes
+  key, <key_size> bytes
+
+  fences, (fences count) * 8 bytes = offsets of records 0, FENCE, 2*FENCE...
+
+All numbers are little-endian.
+"""
+
+import mmap
+import os
+import struct
+from zlib import crc32
+
+
+class KeyIndex(object):
+    """
+    Read-only sorted keys, binary search over fences of mmap-ed file
+    """
+    MAGIC_NUMBER = b'\x6a\xe0\x0a\x6b'
+    VERSION = 1
+    HEADER = struct.Struct('<4siqqq')
+    CHECKSUM = struct.Struct('<I4x')
+    HEADER_SIZE = 40
+    KEY_SIZE = struct.Struct('<I')
+    # keys per fence
+    FENCE = 64
+
+    def __init__(self, filename):
+        """
+        Maps index file
+        raises ValueError if file is not valid key index
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            header = f.read(self.HEADER_SIZE)
+            if len(header) < self.HEADER_SIZE:
+                raise ValueError('key index is too short')
+            magic, version, count, fences, fences_offset = self.HEADER.unpack_from(header)
+            checksum, = self.CHECKSUM.unpack_from(header, self.HEADER.size)
+            if magic != self.MAGIC_NUMBER or version != self.VERSION:
+                raise ValueError('not a key index of version %i' % self.VERSION)
+            if checksum != crc32(header[:self.HEADER.size]):
+                raise ValueError('key index header is broken')
+            f_len = f.seek(0, os.SEEK_END)
+            if f_len != fences_offset + fences * 8:
+                raise ValueError('key index is truncated')
+            self.count = count
+            self.fences = fences
+            self.fences_offset = fences_offset
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __fence__(self, i):
+        """ internal. Returns offset of i-th fence record """
+        return struct.unpack_from('<Q', self.map, self.fences_offset + i * 8)[0]
+
+    def __key_at__(self, pos):
+        """ internal. Returns (key bytes, offset of next record) """
+        size, = self.KEY_SIZE.unpack_from(self.map, pos)
+        pos += self.KEY_SIZE.size
+        return self.map[pos:pos + size], pos + size
+
+    def iter_from(self, start=None):
+        """
+        Generator for keys (str) not less than start, in order
+        """
+        pos = self.HEADER_SIZE
+        if start is not None:
+            start = start.encode()
+        if start is not None and self.fences:
+            # last fence with key <= start
+            lo = 0
+            hi = self.fences
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if self.__key_at__(self.__fence__(mid))[0] <= start:
+                    lo = mid
+                else:
+                    hi = mid
+            pos = self.__fence__(lo)
+        while pos < self.fences_offset:
+            key, pos = self.__key_at__(pos)
+            if start is not None and key < start:
+                continue
+            start = None
+            yield key.decode()
+
+    def __iter__(self):
+        return self.iter_from()
+
+    @classmethod
+    def write(cls, filename, keys):
+        """
+        Writes key index from iterable of keys (str), sorted
+        File is written to filename.tmp and then replaces filename
+        """
+        tmp = filename + '.tmp'
+        count = 0
+        fences = []
+        pos = cls.HEADER_SIZE
+        with open(tmp, 'wb') as f:
+            f.write(bytes(cls.HEADER_SIZE))
+            buf = bytearray()
+            for key in keys:
+                key = key.encode()
+                if count % cls.FENCE == 0:
+                    fences.append(pos)
+                buf += cls.KEY_SIZE.pack(len(key))
+                buf += key
+                pos += cls.KEY_SIZE.size + len(key)
+                count += 1
+                if len(buf) >= 1024 * 1024:
+                    f.write(buf)
+                    del buf[:]
+            f.write(buf)
+            f.write(struct.pack('<%iQ' % len(fences), *fences))
+            header = cls.HEADER.pack(cls.MAGIC_NUMBER, cls.VERSION, count, len(fences), pos)
+            f.seek(0)
+            f.write(header)
+            f.write(cls.CHECKSUM.pack(crc32(header)))
+        os.replace(tmp, filename)
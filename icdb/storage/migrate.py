@@ -0,0 +1,90 @@
+# -------------------------------#
+# Written by icoz, 2013          #
+# email: icoz.vt at gmail.com    #
+# License: GPL v3                #
+# -------------------------------#
+
+"""
+Converts files of FileStorage to current version of on-disk format
+
+Usage:
+  python -m icdb.storage.migrate <filename> [<filename> ...]
+
+filename is the same as passed to FileStorage, e.g. 'my.icdb' for
+my.icdb.key, my.icdb.value, my.icdb.idx
+"""
+
+from hashlib import md5
+import os
+import sys
+from icdb.storage.codec import FLAG_DELETED
+from icdb.storage.file_storage import FileStorage, key_file_version, key_records
+from icdb.storage.index_file import IndexFile
+
+
+def migrate(filename, buffer_size=1024 * 1024):
+    """
+    Converts .key-file of FileStorage 'filename' to current version and
+    writes new .idx for it. Files are streamed through buffer of buffer_size
+    bytes, only index (hash and offsets of every key) is kept in memory.
+    .value-file is not changed: old offsets in blocks become offsets in bytes.
+    Returns True if files were converted, False if they are up to date
+    """
+    key_name = filename + '.key'
+    version = key_file_version(key_name)
+    if version == FileStorage.KEY_VERSION:
+        return False
+    magic, head, block = FileStorage.KEY_FORMATS[FileStorage.KEY_VERSION]
+    # hash -> (key_offset, key_size, flags, value_offset, value_size)
+    index = dict()
+    # offsets of records, updated later in the file
+    old = []
+    with open(key_name, 'rb') as fin, open(key_name + '.migrate', 'wb') as fout:
+        buf = bytearray()
+        pos = 0
+        for flags, key_size, value_offset, value_size, key, key_offset in key_records(
+                fin, version, buffer_size=buffer_size):
+            hash = md5(key).digest()
+            if hash in index:
+                old.append(index[hash][:3])
+            index[hash] = (pos, key_size, flags, value_offset // block, value_size)
+            record = magic + head.pack(key_size, flags, value_offset // block, value_size) + key
+            buf += record
+            pos += len(record)
+            if len(buf) >= buffer_size:
+                fout.write(buf)
+                del buf[:]
+        fout.write(buf)
+        # mark old records deleted
+        for pos, key_size, flags in old:
+            fout.seek(pos + 12)
+            fout.write(bytes([flags | FLAG_DELETED]))
+        fout.flush()
+        os.fsync(fout.fileno())
+    # old index and its journal point to old key records,
+    # without them index is rebuilt
+    for ext in ('.idx', '.journal', '.kdx'):
+        try:
+            os.remove(filename + ext)
+        except FileNotFoundError:
+            pass
+    os.replace(key_name + '.migrate', key_name)
+    IndexFile.write(filename + '.idx',
+                    ((hash,) + index[hash] for hash in sorted(index)))
+    return True
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(__doc__)
+        return 1
+    for filename in argv[1:]:
+        if migrate(filename):
+            print('%s: converted' % filename)
+        else:
+            print('%s: up to date' % filename)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
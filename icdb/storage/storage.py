@@ -6,23 +6,49 @@
 
 '''
 File contains records (variable size) one by one.
-Inspired by Haystack
+Inspired by Haystack and Bitcask
 
 While saving bytes(bytes.decode) is used by default.
 
 Record:
 magic number, 8 bytes
 hash(md5), 16 bytes
-flags, 2 bytes (so big for 8 byte alignment), 0 - ok, 1 - deleted
+flags, 2 bytes (so big for 8 byte alignment), bit 0 - deleted,
+  bits 1-2 - codec of value, see icdb.storage.codec
 key_size, 2 bytes
 value_size, 4 bytes
 key, <key_size> bytes
-value, <value_size> bytes
+value, <value_size> bytes, compressed if codec is set in flags
+
+Segments:
+Log is split into segments. New records are appended to active segment,
+file <fname>. When it grows over segment_size it is sealed: renamed to
+<fname>.<N> (N grows, so bigger N means newer records) and hint file
+<fname>.<N>.hint is written for it.
+If record from sealed segment is deleted, tombstone (record with flags = 1,
+without key and value) is appended to active segment.
+
+Hint file:
+magic number, 8 bytes
+segment size, 8 bytes
+entries, one per record of segment (deleted too), 32 bytes each:
+  hash(md5), 16 bytes
+  flags, 2 bytes
+  key_size, 2 bytes
+  value_size, 4 bytes
+  record offset, 8 bytes
+
+On start only hint files and active segment are read.
 '''
 
 from hashlib import md5
+import mmap
+import os
+import re
 import struct
-from os import rename, remove
+import threading
+from unittest import TestCase
+from icdb.storage.codec import FLAG_DELETED, check_codec, decode, encode
 
 
 def hash_md5(info):
@@ -32,28 +58,93 @@ def hash_md5(info):
     return m.digest()
 
 
+class Segment(object):
+
+    ''' internal. One file of Storage log '''
+
+    def __init__(self, id, filename):
+        self.id = id
+        self.filename = filename
+        # fd for positional reads and for marking records deleted in place
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT)
+        self.size = os.fstat(self.fd).st_size
+        # read-only map of file, remapped when file grows
+        self.map = None
+        self.map_size = 0
+
+    def view(self):
+        ''' returns map of file, maps it again if file has grown '''
+        if self.size == 0:
+            return b''
+        if self.map_size < self.size:
+            # old map is left to gc, it dies with last memoryview of it
+            self.map = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+            self.map_size = self.size
+        return self.map
+
+    def close(self):
+        # map is not closed: memoryviews given by get_view can be still alive
+        self.map = None
+        os.close(self.fd)
+
+
 class Storage(object):
 
     ''' Class Storage for saving key-value pairs using hash '''
     MAGIC_NUMBER = b'\x59\x0d\x1f\x70\xf9\x52\x55\xad'
+    HINT_MAGIC_NUMBER = b'\x59\x0d\x1f\x70\xf9\x52\x48\x54'
 
-    def __init__(self, fname):
-        ''' init Storage using filename for save data '''
+    HEADER_SIZE = 32
+    HINT_SIZE = 32
+    # size of copy buffer used by compress
+    COMPRESS_BUFFER_SIZE = 1024 * 1024
+    # active segment is sealed, when it grows over this size
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # values shorter than this are not compressed
+    CODEC_THRESHOLD = 64
+
+    def __init__(self, fname, segment_size=None, codec=None, codec_threshold=None):
+        '''
+        init Storage using filename for save data
+        codec - 'zlib', 'lzma' or 'bz2' to compress values, None - do not
+        codec_threshold - values shorter than this are stored as is
+        '''
         # print('icdb storage init')
         self.filename = fname
+        if segment_size is None:
+            segment_size = self.SEGMENT_SIZE
+        self.segment_size = segment_size
+        check_codec(codec)
+        self.codec = codec
+        if codec_threshold is None:
+            codec_threshold = self.CODEC_THRESHOLD
+        self.codec_threshold = codec_threshold
+        # guards appends, deletes and segment switch in compress
+        self.lock = threading.RLock()
+        # sealed segments, dict(id: Segment)
+        self.segments = dict()
+        for id in self.__sealed_ids__():
+            self.segments[id] = Segment(id, '%s.%i' % (fname, id))
         self.fout = open(fname, 'ab')
-        pass
+        self.active = Segment(max(self.segments, default=0) + 1, fname)
+        self.segments[self.active.id] = self.active
+        # index is dict(hash: (segment_id, record_offset, key_size, val_size))
+        self.index = dict()
+        self.build_index()
 
     def __del__(self):
         ''' safely close files before die '''
         # print('icdb storage del')
+        if not hasattr(self, 'fout'):
+            # __init__ has failed
+            return
         self.fout.close()
+        for seg in self.segments.values():
+            seg.close()
 
     def __enter__(self):
         ''' for use with with-statement '''
         # print('icdb storage enter')
-        with open(self.filename, 'rb') as fin:
-            self.binary_cache = fin.read()  # read all file
         return self
 
     def __exit__(self, type, value, traceback):
@@ -63,7 +154,7 @@ class Storage(object):
         pass
 
     def set_unsafe(self, key, value):
-        """ append data in storage. NOTE! if there is key, may be duplicates """
+        """ append data in storage. Previous record for key is marked deleted """
         if type(key) is not str:
             key = str(key)
         if type(value) is not str:
@@ -73,128 +164,523 @@ class Storage(object):
 
     def set(self, key, value):
         """ create or update data in storage """
-        self.__delete_by_hash__(hash_md5(key))
+        # previous record is found by index and marked deleted on append
         # TODO tests for time used. To run compress
         self.set_unsafe(key, value)
         pass
 
-    def records(self):
-        """ internal. Generator for records """
-        if 'binary_cache' not in self.__dict__:
-            with open(self.filename, 'rb') as fin:
-                self.binary_cache = fin.read()  # read all file
-        b = self.binary_cache
-        if len(b) > 32:
-            pos = 0
-            while True:
-                pos = b.find(self.MAGIC_NUMBER, pos)
-                if pos == -1:
-                    break
-                hash = b[pos + 8:pos + 24]
+    def set_many(self, pairs, fsync=False):
+        """
+        create or update many pairs in storage with one write
+        pairs is dict or iterable of (key, value)
+        If key repeats in pairs, last value wins.
+        If fsync is True, data is synced to disk before return
+        """
+        if isinstance(pairs, dict):
+            pairs = pairs.items()
+        # resolve overwrites in memory, hash -> (key, value)
+        batch = dict()
+        for key, value in pairs:
+            if type(key) is not str:
+                key = str(key)
+            if type(value) is not str:
+                value = str(value)
+            flags, value = encode(value.encode(), self.codec, self.codec_threshold)
+            batch[hash_md5(key)] = (key.encode(), value, flags)
+        buf = bytearray()
+        for hash, (key, value, flags) in batch.items():
+            buf += self.MAGIC_NUMBER
+            buf += hash
+            buf += struct.pack('hhi', flags, len(key), len(value))
+            buf += key
+            buf += value
+        with self.lock:
+            self.__roll_if_full__(len(buf))
+            pos = self.active.size
+            old = []
+            for hash, (key, value, flags) in batch.items():
+                if hash in self.index:
+                    old.append(self.index[hash])
+                self.index[hash] = (self.active.id, pos, len(key), len(value))
+                pos += self.HEADER_SIZE + len(key) + len(value)
+            self.fout.write(buf)
+            self.fout.flush()
+            self.active.size += len(buf)
+            # new records are on disk, now kill old ones
+            for (seg_id, pos, *rest) in old:
+                self.__mark_deleted__(seg_id, pos)
+            if fsync:
+                os.fsync(self.fout.fileno())
+
+    def build_index(self):
+        """
+        builds index (hash -> record location)
+        Sealed segments are loaded from hint files, active one is scanned
+        """
+        index = dict()
+        for id in sorted(self.segments):
+            seg = self.segments[id]
+            entries = None
+            if seg is not self.active:
+                entries = self.__read_hint__(seg)
+                if entries is None:
+                    entries = self.__write_hint__(seg)
+            else:
+                entries = [(hs, flags, key_size, val_size, pos)
+                           for (pos, hs, flags, key_size, val_size)
+                           in self.__walk__(self.__view__(seg), True)]
+            # newer record wins, deleted record kills older ones
+            for (hs, flags, key_size, val_size, pos) in entries:
+                if not flags & FLAG_DELETED:
+                    index[hs] = (id, pos, key_size, val_size)
+                else:
+                    index.pop(hs, None)
+        self.index = index
+
+    def __sealed_ids__(self):
+        """ internal. Returns sorted ids of sealed segments found on disk """
+        dirname, basename = os.path.split(os.path.abspath(self.filename))
+        pattern = re.compile(re.escape(basename) + r'\.(\d+)$')
+        ids = []
+        for name in os.listdir(dirname):
+            m = pattern.match(name)
+            if m is not None:
+                ids.append(int(m.group(1)))
+        return sorted(ids)
+
+    def __view__(self, seg):
+        """ internal. Returns map of segment """
+        if seg is self.active:
+            self.fout.flush()
+        return seg.view()
+
+    def __read_hint__(self, seg):
+        """
+        internal. Reads hint file of segment
+        returns list of (hash, flags, key_size, val_size, pos)
+        If hint file is absent or does not match segment returns None
+        """
+        try:
+            with open(seg.filename + '.hint', 'rb') as fin:
+                b = fin.read()
+        except FileNotFoundError:
+            return None
+        if len(b) < 16 or b[:8] != self.HINT_MAGIC_NUMBER:
+            return None
+        size, = struct.unpack_from('q', b, 8)
+        if size != seg.size or (len(b) - 16) % self.HINT_SIZE != 0:
+            return None
+        return list(struct.iter_unpack('16shhiq', memoryview(b)[16:]))
+
+    def __write_hint__(self, seg):
+        """
+        internal. Scans segment and writes hint file for it
+        returns list of (hash, flags, key_size, val_size, pos)
+        """
+        entries = [(hs, flags, key_size, val_size, pos)
+                   for (pos, hs, flags, key_size, val_size)
+                   in self.__walk__(self.__view__(seg), True)]
+        buf = bytearray(self.HINT_MAGIC_NUMBER)
+        buf += struct.pack('q', seg.size)
+        for entry in entries:
+            buf += struct.pack('16shhiq', *entry)
+        with open(seg.filename + '.hint.tmp', 'wb') as fout:
+            fout.write(buf)
+        os.replace(seg.filename + '.hint.tmp', seg.filename + '.hint')
+        return entries
+
+    def __roll_if_full__(self, size):
+        """ internal. Seals active segment, if size bytes do not fit in it """
+        if self.active.size == 0:
+            return
+        if self.active.size + size <= self.segment_size:
+            return
+        self.__roll__()
+
+    def __roll__(self):
+        """ internal. Seals active segment and starts new one """
+        with self.lock:
+            self.fout.flush()
+            os.fsync(self.fout.fileno())
+            self.fout.close()
+            seg = self.active
+            seg.filename = '%s.%i' % (self.filename, seg.id)
+            os.replace(self.filename, seg.filename)
+            self.fout = open(self.filename, 'ab')
+            self.active = Segment(seg.id + 1, self.filename)
+            self.segments[self.active.id] = self.active
+            self.__write_hint__(seg)
+
+    def __walk__(self, b, deleted=False):
+        """ internal. Generator for records in buffer b
+        Jumps from header to header using key_size and val_size,
+        magic number is searched only to resync after corrupted record
+        yields: (pos, hash, flags, key_size, val_size) for not deleted records,
+        if deleted is True, then deleted records are yielded too
+        """
+        size = len(b)
+        pos = 0
+        while pos + self.HEADER_SIZE <= size:
+            if b[pos:pos + 8] == self.MAGIC_NUMBER:
                 flags, key_size, val_size = struct.unpack_from(
                     'hhi', b, pos + 24)
-                if flags == 0:
-                    yield (pos, hash, flags, key_size, val_size)
-                pos = pos + 1
+                end = pos + self.HEADER_SIZE + key_size + val_size
+                if key_size >= 0 and val_size >= 0 and end <= size:
+                    if not flags & FLAG_DELETED or deleted:
+                        yield (pos, b[pos + 8:pos + 24], flags,
+                               key_size, val_size)
+                    pos = end
+                    continue
+            # broken record, resync on next magic number
+            pos = b.find(self.MAGIC_NUMBER, pos + 1)
+            if pos == -1:
+                break
+
+    def __pairs__(self):
+        """ internal. Generator for (key, value) of live records, log order """
+        with self.lock:
+            locations = sorted(self.index.values())
+            views = dict((id, memoryview(self.__view__(seg)))
+                         for id, seg in self.segments.items())
+        for (seg_id, pos, key_size, val_size) in locations:
+            v = views[seg_id]
+            flags, = struct.unpack_from('h', v, pos + 24)
+            pos = pos + self.HEADER_SIZE
+            key = str(v[pos:pos + key_size], 'utf-8')
+            value = str(decode(v[pos + key_size:pos + key_size + val_size], flags), 'utf-8')
+            yield (key, value)
 
     def get_list(self):
         """ get all pairs from storage """
-        arr = []
-        with open(self.filename, 'rb') as fin:
-            b = fin.read()
-            for (pos, hs, flags, key_size, val_size) in self.records():
-                key = b[pos + 24 + 2 + 2 + 4:
-                        pos + 24 + 2 + 2 + 4 + key_size].decode()
-                value = b[pos + 24 + 2 + 2 + 4 + key_size:
-                          pos + 24 + 2 + 2 + 4 + key_size + val_size].decode()
-                arr.append((key, value))
-        return arr
+        return list(self.__pairs__())
 
     def get_dict(self):
         ''' get all pairs from storage '''
-        arr = dict()
-        with open(self.filename, 'rb') as fin:
-            b = fin.read()
-            for (pos, hs, flags, key_size, val_size) in self.records():
-                key = b[pos + 24 + 2 + 2 + 4:
-                        pos + 24 + 2 + 2 + 4 + key_size].decode()
-                value = b[pos + 24 + 2 + 2 + 4 + key_size:
-                          pos + 24 + 2 + 2 + 4 + key_size + val_size].decode()
-                # arr.append((key, value))
-                arr[key] = value
-        return arr
-
-    def compress(self):
-        ''' recreates db-file '''
-        self.fout.close()
-        rename(self.filename, self.filename + '.old')
-        with open(self.filename + '.old', 'rb') as fin:
-            b = fin.read()
-        self.fout = open(self.filename, 'ab')
-        pos = 0
-        while True:
-            pos = b.find(self.MAGIC_NUMBER, pos)
-            if pos == -1:
-                break
-                hash = b[pos + 8:pos + 24]
-                flags, key_size, val_size = struct.unpack_from(
-                    'hhi', b, pos + 24)
-                self.fout.write(b[pos:pos + 32 + key_size + val_size])
-            pos = pos + 1
-        remove(self.filename + '.old')
-        with open(self.filename, 'rb') as fin:
-            self.binary_cache = fin.read()
+        return dict(self.__pairs__())
+
+    def compress(self, buffer_size=None):
+        '''
+        recreates db-files, keeping only live (latest) records
+        Active segment is sealed, if it has dead records, then sealed
+        segments are rewritten oldest first. Adjacent segments are merged
+        into one, while their live records fit in segment_size; single
+        segment without dead records is left as is. Records are streamed
+        to new file through buffer of buffer_size bytes. Writers are not
+        stopped, they go to active segment; new segment file replaces old
+        one atomically.
+        '''
+        if buffer_size is None:
+            buffer_size = self.COMPRESS_BUFFER_SIZE
+        with self.lock:
+            live = self.__live_sizes__()
+            if self.active.size > live.get(self.active.id, 0):
+                self.__roll__()
+            # runs of adjacent sealed segments, [(ids, dead bytes), ...]
+            groups = []
+            size = 0
+            for id in sorted(self.segments):
+                if id == self.active.id:
+                    continue
+                seg_live = live.get(id, 0)
+                dead = self.segments[id].size - seg_live
+                if groups and size + seg_live <= self.segment_size:
+                    groups[-1][0].append(id)
+                    groups[-1][1] += dead
+                    size += seg_live
+                else:
+                    groups.append([[id], dead])
+                    size = seg_live
+        for ids, dead in groups:
+            if len(ids) > 1 or dead > 0:
+                self.__compress_segments__(ids, buffer_size)
+
+    def __live_sizes__(self):
+        ''' internal. Returns dict(segment_id: size of live records in it) '''
+        sizes = dict()
+        for (seg_id, pos, key_size, val_size) in self.index.values():
+            sizes[seg_id] = sizes.get(seg_id, 0) + self.HEADER_SIZE + key_size + val_size
+        return sizes
+
+    def __compress_segments__(self, ids, buffer_size):
+        '''
+        internal. Rewrites adjacent sealed segments (sorted ids) into one
+        with live records only. It gets id of newest of them, so segments
+        stay in order of records.
+        Deleted records are dropped too: compress goes oldest first,
+        so there is no older segment, where they must hide something.
+        '''
+        id = ids[-1]
+        with self.lock:
+            segs = [self.segments[i] for i in ids]
+            views = dict((seg.id, memoryview(self.__view__(seg))) for seg in segs)
+            snapshot = dict((hs, loc) for hs, loc in self.index.items()
+                            if loc[0] in views)
+        new_name = segs[-1].filename + '.compress'
+        new_index = dict()
+        with open(new_name, 'w+b') as fnew:
+            # copy live records, in log order
+            buf = bytearray()
+            new_pos = 0
+            for hs, (seg_id, pos, key_size, val_size) in sorted(
+                    snapshot.items(), key=lambda item: item[1][:2]):
+                size = self.HEADER_SIZE + key_size + val_size
+                buf += views[seg_id][pos:pos + size]
+                new_index[hs] = (id, new_pos, key_size, val_size)
+                new_pos += size
+                if len(buf) >= buffer_size:
+                    fnew.write(buf)
+                    del buf[:]
+            fnew.write(buf)
+            del buf
+            for v in views.values():
+                v.release()
+            with self.lock:
+                for hs, loc in new_index.items():
+                    if self.index.get(hs) == snapshot[hs]:
+                        self.index[hs] = loc
+                    else:
+                        # updated or deleted while copying
+                        fnew.seek(loc[1] + 24)
+                        flags = fnew.read(1)[0]
+                        fnew.seek(loc[1] + 24)
+                        fnew.write(bytes([flags | FLAG_DELETED]))
+                fnew.flush()
+                os.fsync(fnew.fileno())
+                for seg in segs:
+                    seg.close()
+                if new_pos == 0:
+                    # nothing left in segments
+                    os.remove(new_name)
+                else:
+                    os.replace(new_name, segs.pop().filename)
+                # older segments go after new one is in place, if crash
+                # comes between, their records are just repeated in it
+                for seg in segs:
+                    os.remove(seg.filename)
+                    os.remove(seg.filename + '.hint')
+                    del self.segments[seg.id]
+                if new_pos == 0:
+                    return
+                seg = Segment(id, '%s.%i' % (self.filename, id))
+                self.segments[id] = seg
+                self.__write_hint__(seg)
 
     def get(self, key):
         ''' returns value by given key. Or None if does not exists '''
+        value = self.get_view(key)
+        if value is None:
+            return None
+        return str(value, 'utf-8')
+
+    def get_view(self, key):
+        '''
+        returns memoryview of value bytes by given key, without copying
+        (compressed value is decompressed, so view is of its copy)
+        Or None if does not exists
+        '''
         if type(key) is not str:
             key = str(key)
         h = hash_md5(key)
         return self.__get_by_hash__(h)
 
     def __get_by_hash__(self, hash):
-        ''' returns value by hash. On fail returns None '''
-        value = None
-        for (pos, hs, flags, key_size, val_size) in self.records():
-            # print("get.record_offset= %i hash = %16s, flags = %s" % (pos, hs,
-            # flags))
-            if hs == hash:
-            # if hs == hash and flags == 0:
-                # parse record
-                # print("get.record_offset= %i hash = %16s, flags = %s, ks=%i,
-                # vs=%i" % (pos, hs, flags, key_size, val_size))
-                # with open(self.filename, 'rb') as fin:
-                #     b = fin.read()
-                b = self.binary_cache
-                value = b[pos + 24 + 2 + 2 + 4 + key_size:
-                          pos + 24 + 2 + 2 + 4 + key_size + val_size].decode()
-        return value
-                # return value
-        # return None
+        ''' returns memoryview of value by hash. On fail returns None '''
+        with self.lock:
+            try:
+                seg_id, pos, key_size, val_size = self.index[hash]
+            except KeyError:
+                return None
+            b = self.__view__(self.segments[seg_id])
+            flags, = struct.unpack_from('h', b, pos + 24)
+            pos = pos + self.HEADER_SIZE + key_size
+            if flags:
+                return memoryview(decode(b[pos:pos + val_size], flags))
+            return memoryview(b)[pos:pos + val_size]
 
     def __set_by_hash__(self, hash, key, value):
         ''' internal. append record. If one exists - mark it deleted '''
-        self.fout.write(self.MAGIC_NUMBER)
-        self.fout.write(hash)
-        # flags = 0
-        s = struct.pack('hhi', 0, len(key), len(value))
-        self.fout.write(s)
-        self.fout.write(key.encode())
-        self.fout.write(value.encode())
-        # self.fout.flush()
+        key = key.encode()
+        flags, value = encode(value.encode(), self.codec, self.codec_threshold)
+        with self.lock:
+            self.__roll_if_full__(self.HEADER_SIZE + len(key) + len(value))
+            old = self.index.get(hash)
+            self.fout.write(self.MAGIC_NUMBER)
+            self.fout.write(hash)
+            s = struct.pack('hhi', flags, len(key), len(value))
+            self.fout.write(s)
+            self.fout.write(key)
+            self.fout.write(value)
+            # self.fout.flush()
+            self.index[hash] = (self.active.id, self.active.size,
+                                len(key), len(value))
+            self.active.size += self.HEADER_SIZE + len(key) + len(value)
+            if old is not None:
+                self.__mark_deleted__(old[0], old[1])
         pass
 
     def delete(self, key):
         ''' delete pair by key '''
+        if type(key) is not str:
+            key = str(key)
         self.__delete_by_hash__(hash_md5(key))
         pass
 
     def __delete_by_hash__(self, hash):
         ''' internal. delete pair by hash '''
-        for (pos, hs, *rest) in self.records():
-            if hs == hash:
-                # set flag deleted
-                with open(self.filename, 'r+b') as f:
-                    f.seek(pos + 24)
-                    f.write(b'\x01')
-        pass
+        with self.lock:
+            try:
+                seg_id, pos, *rest = self.index.pop(hash)
+            except KeyError:
+                return
+            self.__mark_deleted__(seg_id, pos)
+            if seg_id != self.active.id:
+                # hint file of sealed segment knows nothing about it
+                self.fout.write(self.MAGIC_NUMBER)
+                self.fout.write(hash)
+                self.fout.write(struct.pack('hhi', FLAG_DELETED, 0, 0))
+                self.active.size += self.HEADER_SIZE
+
+    def __mark_deleted__(self, seg_id, pos):
+        ''' internal. set flag deleted for record at pos '''
+        if seg_id == self.active.id:
+            # record may still sit in write buffer, flush it before patching
+            self.fout.flush()
+        fd = self.segments[seg_id].fd
+        flags = os.pread(fd, 1, pos + 24)[0]
+        os.pwrite(fd, bytes([flags | FLAG_DELETED]), pos + 24)
+
+
+class StorageTest(TestCase):
+    def setUp(self):
+        for name in os.listdir('.'):
+            if name.startswith('test.storage.icdb'):
+                os.unlink(name)
+        self.s = Storage('test.storage.icdb')
+
+    def test_set_get_delete(self):
+        self.s.set('123', 123)
+        self.assertEqual('123', self.s.get('123'))
+        self.s.set('123', 'some')
+        self.assertEqual('some', self.s.get('123'))
+        self.s.delete('123')
+        self.assertIsNone(self.s.get('123'))
+
+    def test_reopen(self):
+        with self.s as s:
+            s.set_unsafe('1', 'one')
+            s.set_unsafe('1', 'uno')
+            s.set_unsafe('2', 'two')
+        s2 = Storage('test.storage.icdb')
+        self.assertEqual('uno', s2.get('1'))
+        self.assertEqual({'1': 'uno', '2': 'two'}, s2.get_dict())
+        self.assertEqual(2, len(s2.index))
+
+    def test_build_index(self):
+        value = 'значение'
+        self.s.set('1', value)
+        self.s.set('2', 'two')
+        self.s.build_index()
+        self.assertEqual(2, len(self.s.index))
+        self.assertEqual({'1': value, '2': 'two'}, self.s.get_dict())
+
+    def test_get_view(self):
+        self.s.set('1', 'one')
+        view = self.s.get_view('1')
+        self.assertEqual(b'one', view.tobytes())
+        # file grows after map was made
+        self.s.set('2', 'two')
+        self.assertEqual(b'two', self.s.get_view('2').tobytes())
+        self.assertEqual(b'one', view.tobytes())
+
+    def test_compress(self):
+        for i in range(100):
+            self.s.set(i, i)
+        for i in range(50):
+            self.s.set(i, 'new %i' % i)
+        for i in range(50, 75):
+            self.s.delete(i)
+        size = self.s.active.size
+        self.s.compress(buffer_size=256)
+        self.assertLess(sum(seg.size for seg in self.s.segments.values()), size)
+        self.assertEqual('new 1', self.s.get(1))
+        self.assertIsNone(self.s.get(60))
+        self.assertEqual('80', self.s.get(80))
+        with self.s as s:
+            s.set(1, 'after')
+        s2 = Storage('test.storage.icdb')
+        self.assertEqual(75, len(s2.get_dict()))
+        self.assertEqual('after', s2.get(1))
+
+    def test_compress_merge(self):
+        for i in range(200):
+            self.s.set(i, i)
+            self.s.compress()
+        # active segment without dead records is not sealed
+        self.assertEqual(1, len(self.s.segments))
+        s = Storage('test.storage.icdb', segment_size=1024)
+        for i in range(200):
+            s.set(i, 'new %i' % i)
+        for i in range(0, 200, 2):
+            s.delete(i)
+        count = len(s.segments)
+        s.compress()
+        # half of records is left, so small segments are merged
+        self.assertLess(len(s.segments), count * 2 / 3)
+        for seg in s.segments.values():
+            self.assertLessEqual(seg.size, 1024)
+        self.assertEqual('new 51', s.get(51))
+        self.assertIsNone(s.get(50))
+        s2 = Storage('test.storage.icdb', segment_size=1024)
+        self.assertEqual(s.get_dict(), s2.get_dict())
+        self.assertEqual(100, len(s2.index))
+        # nothing to drop or merge, files are not rewritten
+        names = dict((id, os.stat(seg.filename).st_ino) for id, seg in s2.segments.items())
+        s2.compress()
+        self.assertEqual(names, dict((id, os.stat(seg.filename).st_ino) for id, seg in s2.segments.items()))
+
+    def test_set_many(self):
+        self.s.set('1', 'old')
+        self.s.set_many([('1', 'one'), (2, 'two'), (2, 'deux')], fsync=True)
+        self.s.set_many({'3': 3})
+        self.assertEqual('one', self.s.get('1'))
+        self.assertEqual('deux', self.s.get(2))
+        s2 = Storage('test.storage.icdb')
+        self.assertEqual({'1': 'one', '2': 'deux', '3': '3'}, s2.get_dict())
+
+    def test_segments(self):
+        s = Storage('test.storage.icdb', segment_size=512)
+        with s:
+            for i in range(100):
+                s.set(i, i)
+            for i in range(50):
+                s.delete(i)
+            s.set(99, 'last')
+        self.assertGreater(len(s.segments), 2)
+        self.assertTrue(os.path.exists('test.storage.icdb.1.hint'))
+        s2 = Storage('test.storage.icdb', segment_size=512)
+        self.assertEqual(50, len(s2.index))
+        self.assertIsNone(s2.get(10))
+        self.assertEqual('last', s2.get(99))
+        s2.compress()
+        s3 = Storage('test.storage.icdb', segment_size=512)
+        self.assertEqual(s2.get_dict(), s3.get_dict())
+        self.assertEqual('60', s3.get(60))
+
+    def test_codec(self):
+        self.assertRaises(ValueError, Storage, 'test.storage.icdb', codec='gzip')
+        s = Storage('test.storage.icdb', codec='zlib', segment_size=4096)
+        text = 'some repetitive text ' * 100
+        with s:
+            s.set('long', text)
+            s.set('short', 'tiny')
+            s.set_many([('many', text), ('other', text)])
+            s.set('other', 'x' * 100)
+            s.delete('many')
+        self.assertLess(os.path.getsize('test.storage.icdb'), len(text))
+        self.assertEqual(text, s.get('long'))
+        self.assertEqual('tiny', s.get('short'))
+        s.compress()
+        s2 = Storage('test.storage.icdb')
+        self.assertEqual({'long': text, 'short': 'tiny', 'other': 'x' * 100},
+                         s2.get_dict())
+        self.assertEqual(text, bytes(s2.get_view('long')).decode())
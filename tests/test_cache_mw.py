@@ -2,14 +2,17 @@ from icdb.memcache.cache_mw import CacheMW
 from math import sin, pi
 from datetime import timedelta, datetime
 from random import randint
+import sys
 
 # consts for playing with CacheTTL
 COUNT = 10000
 LIMIT = 10005
+# eviction policy, can be passed as first argument: lru, tinylfu, arc, 2q
+POLICY = sys.argv[1] if len(sys.argv) > 1 else 'lru'
 
 
 def main():
-    c = CacheMW(limit=LIMIT)
+    c = CacheMW(limit=LIMIT, policy=POLICY)
     cache_miss = 0
     cache_hit = 0
 
@@ -33,6 +36,7 @@ def main():
             print('  cache miss = %i' % cache_miss)
             print('  cache hit = %i' % cache_hit)
     print('Total time for test = ', datetime.utcnow() - start_time_total)
+    print('Hit ratio (%s) = %.3f' % (POLICY, cache_hit / (cache_hit + cache_miss)))
 
 if __name__ == '__main__':
     main()